@@ -0,0 +1,317 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+
+_inverseTables = OrderedDict() # Most recently used last
+_maxInverseTables = 32
+
+def _pointCharge(chargeFunc):
+    """
+    chargeFunc for a single (voltage, fluence) point, a charge too large to compute (e.g. math.exp overflowing past
+    the window, which the original scan never reached) counts as infinite
+    """
+    def charge(volt, phi):
+        try:
+            return chargeFunc(volt, phi)
+        except (OverflowError, FloatingPointError):
+            return float('inf')
+    return charge
+
+def _evaluateCharge(chargeFunc, volts, phi):
+    """chargeFunc on the (fluence, voltage) grid, falls back to one call per point if it does not broadcast"""
+    import numpy as np
+
+    try:
+        charge = np.asarray(chargeFunc(volts[None, :], phi[:, None]), dtype=np.float64)
+        if charge.shape == (len(phi), len(volts)):
+            return charge
+    except (TypeError, ValueError, OverflowError, FloatingPointError):
+        pass
+
+    with np.errstate(over='ignore'):
+        return np.vectorize(_pointCharge(chargeFunc), otypes=[np.float64])(volts[None, :], phi[:, None])
+
+def solveVoltageWindow(chargeFunc, phi, minCharge=10, maxCharge=100, maxVolt=700, chunkSize=1 << 22):
+    """
+    phi - array of fluences, in the units expected by chargeFunc(Volt, phi)
+    Returns the (minV, maxV) arrays of the integer voltage window of every fluence, with the same meaning as
+    SensorPad.getVoltageEOL: minV is the first voltage with charge >= minCharge, maxV the last one before
+    charge > maxCharge, NaN where there is no such voltage up to maxVolt
+    """
+    import numpy as np
+
+    phi = np.asarray(phi, dtype=np.float64)
+    uniquePhi, inverse = np.unique(phi.ravel(), return_inverse=True)
+    volts = np.arange(1, maxVolt+1, dtype=np.float64)
+
+    minV = np.full(len(uniquePhi), np.nan)
+    maxV = np.full(len(uniquePhi), np.nan)
+
+    # Evaluate the (fluence, voltage) grid in chunks to bound the memory used
+    step = max(1, chunkSize//max(1, len(volts)))
+    for start in range(0, len(uniquePhi), step):
+        charge = _evaluateCharge(chargeFunc, volts, uniquePhi[start:start+step])
+
+        aboveMin = charge >= minCharge
+        found = aboveMin.any(axis=1)
+        minV[start:start+step][found] = volts[aboveMin.argmax(axis=1)][found]
+
+        aboveMax = charge > maxCharge
+        found = aboveMax.any(axis=1)
+        maxV[start:start+step][found] = volts[aboveMax.argmax(axis=1)][found] - 1
+
+    return minV[inverse].reshape(phi.shape), maxV[inverse].reshape(phi.shape)
+
+def _evaluateChargePairs(chargeFunc, volts, phi):
+    """chargeFunc for every (voltage, fluence) pair, falls back to one call per pair if it does not broadcast"""
+    import numpy as np
+
+    try:
+        charge = np.asarray(chargeFunc(volts, phi), dtype=np.float64)
+        if charge.shape == phi.shape:
+            return charge
+    except (TypeError, ValueError, OverflowError, FloatingPointError):
+        pass
+
+    with np.errstate(over='ignore'):
+        return np.vectorize(_pointCharge(chargeFunc), otypes=[np.float64])(volts, phi)
+
+def _bisectFirstVoltage(chargeFunc, phi, above, maxVolt, integerVolts, iterations):
+    """
+    First voltage in [1, maxVolt] where above(charge) holds, for a charge increasing with the voltage
+    NaN where it never holds
+    """
+    import numpy as np
+
+    low = np.ones(phi.shape)
+    high = np.full(phi.shape, float(maxVolt))
+
+    result = np.full(phi.shape, np.nan)
+    atLow = above(_evaluateChargePairs(chargeFunc, low, phi))
+    atHigh = above(_evaluateChargePairs(chargeFunc, high, phi))
+    result[atLow] = 1
+
+    # Keep low where the condition fails and high where it holds
+    active = atHigh & ~atLow
+    for _ in range(iterations):
+        if integerVolts:
+            active &= high - low > 1
+        if not active.any():
+            break
+        mid = (low + high)/2
+        if integerVolts:
+            mid = np.floor(mid)
+        holds = above(_evaluateChargePairs(chargeFunc, np.where(active, mid, high), phi))
+        high = np.where(active & holds, mid, high)
+        low = np.where(active & ~holds, mid, low)
+
+    result[atHigh & ~atLow] = high[atHigh & ~atLow]
+    return result
+
+def bisectVoltageWindow(chargeFunc, phi, minCharge=10, maxCharge=100, maxVolt=700, integerVolts=True, iterations=60):
+    """
+    Same window as solveVoltageWindow, found by bisection, which is only valid if the charge increases with the voltage
+    With integerVolts the voltages are whole volts, as in the scan, otherwise the crossing points themselves
+    """
+    import numpy as np
+
+    phi = np.asarray(phi, dtype=np.float64)
+    uniquePhi, inverse = np.unique(phi.ravel(), return_inverse=True)
+
+    minV = _bisectFirstVoltage(chargeFunc, uniquePhi, lambda charge: charge >= minCharge, maxVolt, integerVolts, iterations)
+    maxV = _bisectFirstVoltage(chargeFunc, uniquePhi, lambda charge: charge > maxCharge, maxVolt, integerVolts, iterations)
+    if integerVolts:
+        maxV -= 1 # The last voltage before going over the maximum charge
+    else:
+        maxV[maxV == 1] = 0 # Already over the maximum charge at the lowest voltage, as in the scan
+
+    return minV[inverse].reshape(phi.shape), maxV[inverse].reshape(phi.shape)
+
+class ChargeInverseTable:
+    """
+    Voltage window of a chargeFunc tabulated on a fluence grid from 0 to phiMax, Vmin(phi) and Vmax(phi) are the
+    voltages where the charge crosses minCharge and maxCharge, only valid if the charge increases with the voltage
+    """
+    def __init__(self, chargeFunc, minCharge=10, maxCharge=100, maxVolt=700, phiMax=1e17, points=4097):
+        import numpy as np
+
+        self.minCharge = minCharge
+        self.maxCharge = maxCharge
+        self.maxVolt = maxVolt
+        self.phi = np.linspace(0, phiMax, points)
+
+        self.minV, self.maxV = bisectVoltageWindow(chargeFunc, self.phi, minCharge=minCharge, maxCharge=maxCharge, maxVolt=maxVolt, integerVolts=False)
+        # Past maxVolt there is no window, keep the tables continuous there so the interpolation stays meaningful
+        self.minV[np.isnan(self.minV)] = maxVolt + 1
+        self.maxV[np.isnan(self.maxV)] = maxVolt + 1
+
+    @property
+    def phiMax(self):
+        return float(self.phi[-1])
+
+    def __call__(self, phi, integerVolts=True):
+        """
+        (minV, maxV) arrays of the interpolated window of every fluence in phi, NaN where there is none
+        With integerVolts the crossing points are rounded to the whole volt window of the scan
+        """
+        import numpy as np
+
+        phi = np.asarray(phi, dtype=np.float64)
+        if phi.size != 0 and phi.max() > self.phiMax:
+            raise ValueError("Fluence {} is outside of the table, which goes up to {}".format(phi.max(), self.phiMax))
+
+        minV = np.interp(phi, self.phi, self.minV)
+        maxV = np.interp(phi, self.phi, self.maxV)
+        if integerVolts:
+            minV = np.maximum(np.ceil(minV), 1)
+            maxV = np.floor(maxV)
+        minV[minV > self.maxVolt] = np.nan
+        maxV[maxV > self.maxVolt] = np.nan
+
+        return minV, maxV
+
+def _valueKey(value, seen):
+    """
+    Hashable key of value that only depends on its contents, raises TypeError for values it can not compare that way
+    Functions are keyed by their code and everything they read, see _functionKey
+    """
+    import types
+    from functools import partial
+    import numpy as np
+
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes, np.generic)):
+        return (type(value).__name__, value)
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            raise TypeError("Can not key an object array")
+        return ('ndarray', value.dtype.str, value.shape, value.tobytes())
+    if isinstance(value, (tuple, list)):
+        return (type(value).__name__,) + tuple(_valueKey(item, seen) for item in value)
+    if isinstance(value, dict):
+        return ('dict',) + tuple(sorted((_valueKey(k, seen), _valueKey(v, seen)) for k, v in value.items()))
+    if isinstance(value, types.ModuleType):
+        return ('module', value.__name__)
+    if isinstance(value, (types.BuiltinFunctionType, np.ufunc)):
+        return ('builtin', getattr(value, '__module__', None), value.__name__)
+    if isinstance(value, (types.FunctionType, partial)):
+        return _functionKey(value, seen)
+    raise TypeError("Can not key a {} by value".format(type(value).__name__))
+
+def _codeNames(code):
+    """Global names read by code and the functions defined inside it"""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, 'co_names'):
+            names |= _codeNames(const)
+    return names
+
+def _functionKey(chargeFunc, seen=None):
+    """
+    Hashable key of chargeFunc made of its code, defaults, closure and the globals it reads, compared by value and
+    followed into the helper functions it calls, so refitting the model parameters does not reuse a stale table
+    Returns None when some of them can not be compared by value (e.g. an object holding the parameters)
+    """
+    import types
+    from functools import partial
+
+    seen = set() if seen is None else seen
+    try:
+        if isinstance(chargeFunc, partial):
+            return ('partial', _functionKey(chargeFunc.func, seen), _valueKey(chargeFunc.args, seen), _valueKey(chargeFunc.keywords, seen))
+        if not isinstance(chargeFunc, types.FunctionType):
+            return None
+
+        code = chargeFunc.__code__
+        if id(code) in seen:
+            return ('recursive', code) # Already being keyed further up, e.g. a recursive helper
+        seen = seen | {id(code)}
+
+        closure = tuple(_valueKey(cell.cell_contents, seen) for cell in (chargeFunc.__closure__ or ()))
+        names = tuple((name, _valueKey(chargeFunc.__globals__[name], seen)) for name in sorted(_codeNames(code)) if name in chargeFunc.__globals__)
+        key = ('function', code, _valueKey(chargeFunc.__defaults__, seen), _valueKey(chargeFunc.__kwdefaults__, seen), closure, names)
+        hash(key)
+        return key
+    except (TypeError, ValueError):
+        return None
+
+def chargeInverseTable(chargeFunc, minCharge=10, maxCharge=100, maxVolt=700, phiMax=1e17, points=4097, cacheKey=None):
+    """
+    Cached ChargeInverseTable of chargeFunc(Volt, phi), the table is only built once for each function and parameters
+    The function is keyed by value (see _functionKey), when that is not possible the table is built on every call,
+    unless cacheKey is given: a hashable key naming the function and its parameters, that must change with them
+    The last _maxInverseTables tables used are kept
+    """
+    key = _functionKey(chargeFunc) if cacheKey is None else ('cacheKey', cacheKey)
+    if key is None:
+        return ChargeInverseTable(chargeFunc, minCharge=minCharge, maxCharge=maxCharge, maxVolt=maxVolt, phiMax=phiMax, points=points)
+
+    key = (key, minCharge, maxCharge, maxVolt, phiMax, points)
+    if key in _inverseTables:
+        _inverseTables.move_to_end(key)
+    else:
+        _inverseTables[key] = ChargeInverseTable(chargeFunc, minCharge=minCharge, maxCharge=maxCharge, maxVolt=maxVolt, phiMax=phiMax, points=points)
+        while len(_inverseTables) > _maxInverseTables:
+            _inverseTables.popitem(last=False)
+    return _inverseTables[key]
+
+def cellVoltageWindows(chargeFunc, phi, minCharge=10, maxCharge=100, maxVolt=700, solver="grid", integerVolts=True, cacheKey=None):
+    """
+    Voltage window of every fluence in phi, NaN where there is none
+    solver - "grid" evaluates chargeFunc on every whole volt up to maxVolt
+             "bisect" uses a bisection, valid when the charge increases with the voltage
+             "table" interpolates the cached chargeInverseTable, same assumption as "bisect" and approximate
+             within the table spacing, whole volt windows can be 1 or 2 V off the "grid" ones for a few cells
+    cacheKey - key of chargeFunc for the "table" solver, see chargeInverseTable
+    """
+    import numpy as np
+
+    if solver == "grid":
+        if not integerVolts:
+            raise ValueError("The grid solver only works in whole volts, use the bisect solver instead")
+        return solveVoltageWindow(chargeFunc, phi, minCharge=minCharge, maxCharge=maxCharge, maxVolt=maxVolt)
+    if solver == "bisect":
+        return bisectVoltageWindow(chargeFunc, phi, minCharge=minCharge, maxCharge=maxCharge, maxVolt=maxVolt, integerVolts=integerVolts)
+    if solver == "table":
+        phi = np.asarray(phi, dtype=np.float64)
+        # Round the fluence range up to a power of 2, so close doses share the same table
+        phiMax = float(2**np.ceil(np.log2(phi.max()))) if phi.size != 0 and phi.max() > 0 else 1.
+        table = chargeInverseTable(chargeFunc, minCharge=minCharge, maxCharge=maxCharge, maxVolt=maxVolt, phiMax=phiMax, cacheKey=cacheKey)
+        return table(phi, integerVolts=integerVolts)
+    raise ValueError("Unknown voltage solver {}".format(solver))
+
+def padVoltageWindow(minV, maxV, integerVolts=True):
+    """
+    Reduces the per cell windows of one pad to the pad window, as SensorPad.getVoltageEOL does
+    Returns (None, None) when a cell never reaches the minimum charge
+    """
+    import numpy as np
+
+    if np.isnan(minV).any():
+        return (None, None)
+
+    convert = int if integerVolts else float
+    padMaxV = None
+    if not np.isnan(maxV).all():
+        padMaxV = convert(np.nanmin(maxV))
+    return (convert(np.max(minV)), padMaxV)
+
+def windowClosingLuminosity(lumi, minVolt, maxVolt):
+    """
+    Interpolated luminosity where the voltage window closes (maxVolt < minVolt), None if it stays open
+    A NaN minimum voltage, no working voltage at all, counts as a closed window
+    """
+    import numpy as np
+
+    lumi = np.asarray(lumi, dtype=np.float64)
+    gap = np.asarray(maxVolt, dtype=np.float64) - np.asarray(minVolt, dtype=np.float64)
+    gap[np.isnan(np.asarray(minVolt, dtype=np.float64))] = np.nan
+    gap[np.isnan(gap) & ~np.isnan(np.asarray(minVolt, dtype=np.float64))] = np.inf # No upper limit
+
+    closed = np.nonzero(~(gap >= 0))[0]
+    if len(closed) == 0:
+        return None
+
+    idx = closed[0]
+    if idx == 0 or np.isnan(gap[idx]) or np.isinf(gap[idx-1]):
+        return float(lumi[idx])
+    return float(lumi[idx-1] + (lumi[idx] - lumi[idx-1]) * gap[idx-1]/(gap[idx-1] - gap[idx]))
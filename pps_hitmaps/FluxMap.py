@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+class FluxMap:
+    """
+    Flux of the hitmap bins covered by a pad during one epoch
+    Only a window of the hitmap grid and its bin centres are kept, the per bin dicts are built while iterating
+    """
+    fields = ('flux', 'x', 'y', 'xLocal', 'yLocal', 'leftLocal', 'rightLocal', 'topLocal', 'bottomLocal')
+
+    def __init__(self,
+                 fluence, # (x bins, y bins) array of fluences, NaN marks a missing entry
+                 xVals, # bin centres in mm
+                 yVals, # bin centres in mm
+                 xStep, # bin size in mm
+                 yStep, # bin size in mm
+                 centerX, # pad centre in mm
+                 centerY, # pad centre in mm
+                 fraction = 1 # Scale of the flux, for partially completed epochs
+                ):
+        self.fluence = fluence
+        self.xVals = xVals
+        self.yVals = yVals
+        self.xStep = xStep
+        self.yStep = yStep
+        self.centerX = centerX
+        self.centerY = centerY
+        self.fraction = fraction
+        self._validIdx = None # (x indices, y indices) of the bins with an entry, found on first use
+
+    def _valid(self):
+        """(x indices, y indices) of the bins with an entry, in iteration order"""
+        import numpy as np
+
+        if self._validIdx is None:
+            self._validIdx = np.nonzero(self.fluence == self.fluence)
+        return self._validIdx
+
+    def scaled(self, fraction):
+        """Same bins, with the flux scaled by fraction"""
+        scaled = FluxMap(self.fluence, self.xVals, self.yVals, self.xStep, self.yStep, self.centerX, self.centerY, fraction=self.fraction*fraction)
+        scaled._validIdx = self._validIdx
+        return scaled
+
+    @property
+    def flux(self):
+        """(x bins, y bins) array of the flux, NaN marks a missing entry"""
+        return self.fluence * self.fraction
+
+    @property
+    def leftLocal(self):
+        return self.xVals - self.xStep/2 - self.centerX
+
+    @property
+    def rightLocal(self):
+        return self.xVals + self.xStep/2 - self.centerX
+
+    @property
+    def bottomLocal(self):
+        return self.yVals - self.yStep/2 - self.centerY
+
+    @property
+    def topLocal(self):
+        return self.yVals + self.yStep/2 - self.centerY
+
+    def __len__(self):
+        return len(self._valid()[0])
+
+    def __iter__(self):
+        yList = self.yVals.tolist()
+        for xVal, row in zip(self.xVals.tolist(), self.fluence.tolist()):
+            left = xVal - self.xStep/2
+            right = xVal + self.xStep/2
+            for yVal, fluence in zip(yList, row):
+                if fluence != fluence: # NaN marks a missing entry
+                    continue
+
+                bottom = yVal - self.yStep/2
+                top = yVal + self.yStep/2
+                yield {
+                    'flux': fluence * self.fraction,
+                    'x': xVal,
+                    'y': yVal,
+                    'xLocal': xVal - self.centerX,
+                    'yLocal': yVal - self.centerY,
+                    'leftLocal': left - self.centerX,
+                    'rightLocal': right - self.centerX,
+                    'topLocal': top - self.centerY,
+                    'bottomLocal': bottom - self.centerY,
+                }
+
+    def __getitem__(self, idx):
+        xIdx, yIdx = self._valid()
+        if idx < -len(xIdx) or idx >= len(xIdx):
+            raise IndexError("FluxMap index out of range")
+        xIdx = int(xIdx[idx])
+        yIdx = int(yIdx[idx])
+
+        window = FluxMap(self.fluence[xIdx:xIdx+1, yIdx:yIdx+1], self.xVals[xIdx:xIdx+1], self.yVals[yIdx:yIdx+1],
+                         self.xStep, self.yStep, self.centerX, self.centerY, fraction=self.fraction)
+        return next(iter(window))
+
+    def toArray(self):
+        """Structured array with one record per bin and the same fields as the dicts"""
+        import numpy as np
+
+        xIdx, yIdx = self._valid()
+
+        array = np.zeros(len(xIdx), dtype=[(field, np.float64) for field in self.fields])
+        array['flux'] = self.fluence[xIdx, yIdx] * self.fraction
+        array['x'] = self.xVals[xIdx]
+        array['y'] = self.yVals[yIdx]
+        array['xLocal'] = self.xVals[xIdx] - self.centerX
+        array['yLocal'] = self.yVals[yIdx] - self.centerY
+        array['leftLocal'] = self.leftLocal[xIdx]
+        array['rightLocal'] = self.rightLocal[xIdx]
+        array['topLocal'] = self.topLocal[yIdx]
+        array['bottomLocal'] = self.bottomLocal[yIdx]
+        return array
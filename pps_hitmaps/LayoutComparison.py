@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+from .PPSHitmap import PPSHitmap
+from .Sensor import batchFlux, _batchRows, _dosesFromBatch, _mapPads, _roiMask
+
+def _designList(designs):
+    """Normalises the designs to (name, sensor class, kwargs) tuples"""
+    designList = []
+    for design in designs:
+        if isinstance(design, type):
+            designList += [(design.__name__, design, {})]
+        elif len(design) == 2:
+            designList += [(design[0].__name__, design[0], dict(design[1]))]
+        elif len(design) == 3:
+            designList += [(design[0], design[1], dict(design[2]))]
+        else:
+            raise ValueError("Expected a sensor class, (class, kwargs) or (name, class, kwargs), got {}".format(design))
+    return designList
+
+def _scheduleList(shiftSchedules):
+    """Normalises the shift schedules to (name, shifts) tuples"""
+    if isinstance(shiftSchedules, dict):
+        return [(name, list(shifts)) for name, shifts in shiftSchedules.items()]
+    return [(idx, list(shifts)) for idx, shifts in enumerate(shiftSchedules)]
+
+def _padKey(pad):
+    return (pad.minX, pad.maxX, pad.minY, pad.maxY, pad.minX_extra, pad.maxX_extra, pad.minY_extra, pad.maxY_extra)
+
+def compareLayouts(designs,
+                   hitmap:PPSHitmap,
+                   shiftSchedules,
+                   chargeFunc = None, # chargeFunc(Volt, phi), without it the voltage window is not calculated
+                   integratedLuminosity = 300, # in fb-1
+                   usePadSpacing = True,
+                   minCharge = 10, # in fC
+                   maxCharge = 100, # in fC
+                   maxVolt = 700,
+                   solver = "grid",
+                   cacheKey = None, # Key of chargeFunc for the "table" solver, see SensorPad.getVoltageEOL
+                   nWorkers = None # Number of worker processes for the per pad doses and windows, None to work in this process
+                  ):
+    """
+    designs - list of sensor classes, (class, kwargs) or (name, class, kwargs), e.g. [SimpleETLSensor, (PPSHybrid3Sensor, {'PadSize': 1.0})]
+    shiftSchedules - list of shift lists (named by their index) or dict of name to shift list, shifts in mm
+    Returns a list of rows, one per design, schedule and epoch, with the keys: design, schedule, epoch,
+    maxOccupancy (of the epoch), maxDoseEOL (p/cm^2), minVoltage and maxVoltage (None as in getVoltageEOL)
+    Pads that are identical between designs are only calculated once, and only the pads that can set the maximum
+    dose or the voltage window of their design are evaluated in detail
+    """
+    import numpy as np
+    from .ChargeSolver import padVoltageWindow
+
+    hitmap._checkMap()
+
+    designList = _designList(designs)
+    rows = []
+    for scheduleName, shifts in _scheduleList(shiftSchedules):
+        sensors = [cls(shifts=shifts, **kwargs) for name, cls, kwargs in designList]
+
+        # Map every pad to its row in the unique pads of all the designs
+        uniqueRows = {}
+        uniquePads = []
+        padRows = []
+        for sensor in sensors:
+            for pad in sensor.padVec:
+                if pad.epochs != len(shifts):
+                    raise ValueError(f'Expected the number of shift positions to match the number of epochs')
+                key = _padKey(pad)
+                if key not in uniqueRows:
+                    uniqueRows[key] = len(uniquePads)
+                    uniquePads += [pad]
+            padRows += [np.array([uniqueRows[_padKey(pad)] for pad in sensor.padVec], dtype=np.int64)]
+
+        bounds = np.array([key[:4] for key in uniqueRows], dtype=np.float64).reshape(-1, 4)
+        boundsExtra = np.array([key[4:] for key in uniqueRows], dtype=np.float64).reshape(-1, 4)
+        doses = batchFlux(hitmap, bounds, shifts)
+        doses_extra = batchFlux(hitmap, boundsExtra, shifts)
+
+        # The pads of each design that can set its maximum dose or voltage window
+        roi = "dose" if chargeFunc is None else "voltage"
+        binArea = hitmap.xStep * hitmap.yStep * 1e6 # in mm^2
+        roiBatch = doses if usePadSpacing else doses_extra
+        roiBounds = bounds if usePadSpacing else boundsExtra
+        roiRows = [designRows[_roiMask(_batchRows(roiBatch, designRows), roiBounds[designRows], binArea, roi)] for designRows in padRows]
+
+        evaluated = sorted(set(int(row) for designRows in roiRows for row in designRows))
+        for row in evaluated:
+            uniquePads[row].doses = _dosesFromBatch(hitmap, doses, row)
+            uniquePads[row].doses_extra = _dosesFromBatch(hitmap, doses_extra, row)
+
+        padDoses = np.full(len(uniquePads), np.nan)
+        padDoses[evaluated] = _mapPads([uniquePads[row] for row in evaluated], "maxDoseEOL", nWorkers=nWorkers,
+                                       integratedLuminosity=integratedLuminosity, usePadSpacing=usePadSpacing)
+        if chargeFunc is not None:
+            windows = _mapPads([uniquePads[row] for row in evaluated], "getVoltageEOL", nWorkers=nWorkers,
+                               chargeFunc=chargeFunc, integratedLuminosity=integratedLuminosity, usePadSpacing=usePadSpacing,
+                               minCharge=minCharge, maxCharge=maxCharge, maxVolt=maxVolt, solver=solver, cacheKey=cacheKey)
+            padMinV = np.full(len(uniquePads), np.nan)
+            padMaxV = np.full(len(uniquePads), np.nan)
+            padMinV[evaluated] = [np.nan if minV is None else minV for minV, maxV in windows]
+            padMaxV[evaluated] = [np.nan if maxV is None else maxV for minV, maxV in windows]
+
+        occupancy = roiBatch['occupancy']
+        for (name, cls, kwargs), designRows, rowIdx in zip(designList, padRows, roiRows):
+            if len(designRows) == 0:
+                continue
+
+            minV, maxV = None, None
+            if chargeFunc is not None:
+                minV, maxV = padVoltageWindow(padMinV[rowIdx], padMaxV[rowIdx])
+
+            maxOccupancy = occupancy[designRows].max(axis=0)
+            for epoch in range(len(shifts)):
+                rows += [{
+                    'design': name,
+                    'schedule': scheduleName,
+                    'epoch': epoch,
+                    'maxOccupancy': float(maxOccupancy[epoch]),
+                    'maxDoseEOL': float(padDoses[rowIdx].max()),
+                    'minVoltage': minV,
+                    'maxVoltage': maxV,
+                    }]
+
+    return rows
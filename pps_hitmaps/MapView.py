@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+from collections.abc import Mapping
+
+class MapView(Mapping):
+    """
+    Read only {x: {y: fluence}} view of a hitmap grid, with the bin centres in m as keys, as the original map dict
+    Nothing is copied up front, a column dict is only built when it is accessed and only the last one is kept
+    Writing to it raises a TypeError, the grid is the only copy of the fluences
+    """
+    def __init__(self,
+                 grid, # (x bins, y bins) array or TiledGrid of fluences, NaN marks a missing entry
+                 xAxis, # bin centres in m
+                 yAxis # bin centres in m
+                ):
+        self.grid = grid
+        self.xAxis = xAxis
+        self.yAxis = yAxis
+        self._xIndex = None # Grid index of every x with at least one entry, built on first use
+        self._yList = yAxis.tolist()
+        self._column = None # (x index, read only column) of the last column accessed
+
+    def _index(self):
+        import numpy as np
+
+        if self._xIndex is None:
+            self._xIndex = {}
+            for i, xVal in enumerate(self.xAxis.tolist()):
+                if not np.isnan(self.grid[i, :]).all():
+                    self._xIndex[xVal] = i
+        return self._xIndex
+
+    def __getitem__(self, x):
+        from types import MappingProxyType
+
+        i = self._index()[x]
+        if self._column is None or self._column[0] != i:
+            row = self.grid[i, :].tolist()
+            column = {yVal: fluence for yVal, fluence in zip(self._yList, row) if fluence == fluence} # NaN marks a missing entry
+            self._column = (i, MappingProxyType(column))
+        return self._column[1]
+
+    def __getstate__(self):
+        # The cached column is a read only proxy, which can not be pickled, it is built again when accessed
+        state = self.__dict__.copy()
+        state['_column'] = None
+        return state
+
+    def __iter__(self):
+        return iter(self._index())
+
+    def __len__(self):
+        return len(self._index())
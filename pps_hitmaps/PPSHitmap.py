@@ -1,5 +1,69 @@
 from __future__ import annotations
 
+def _lineChunks(filename, nChunks):
+    """Splits the file in nChunks (start, stop) byte ranges, each starting at the beginning of a line"""
+    import os
+
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as file:
+        for chunk in range(1, nChunks):
+            file.seek(max(bounds[-1], size*chunk//nChunks))
+            file.readline() # Move on to the start of the next line
+            bounds += [min(file.tell(), size)]
+    bounds += [size]
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if start < stop]
+
+def _parseColumns(text, filename):
+    """(x, y, fluence) rows of the whitespace separated text, parsed in one vectorized call"""
+    import warnings
+    import numpy as np
+
+    with warnings.catch_warnings():
+        # Older numpy versions only warn when they stop at a malformed entry
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            values = np.fromstring(text, dtype=np.float64, sep=' ')
+        except (ValueError, DeprecationWarning) as e:
+            raise ValueError("Could not parse the fluence entries of {}: {}".format(filename, e))
+
+    if len(values) % 3 != 0:
+        raise ValueError("Expected x, y and fluence on every line of {}".format(filename))
+    return values.reshape(-1, 3)
+
+def _parseChunk(filename, start, stop, window=None, blockSize=1 << 26):
+    """
+    Parses the lines between the byte offsets start and stop, reading blockSize bytes at a time
+    window - (xMin, xStep, x bins, yMin, yStep, y bins), only the entries in these bins are kept, None to keep all
+    Returns the (x, y, fluence) columns
+    """
+    import numpy as np
+
+    blocks = []
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        remainder = b''
+        last = start >= stop
+        while not last:
+            read = file.read(min(blockSize, stop - start))
+            start += len(read)
+            last = start >= stop or len(read) == 0
+            data = remainder + read
+            # Only parse complete lines, the rest is carried over to the next block
+            end = len(data) if last else data.rfind(b'\n') + 1
+            if end != 0:
+                rows = _parseColumns(data[:end].decode('ascii'), filename)
+                if window is not None:
+                    xMin, xStep, nx, yMin, yStep, ny = window
+                    xIdx = np.rint((rows[:, 0] - xMin)/xStep)
+                    yIdx = np.rint((rows[:, 1] - yMin)/yStep)
+                    rows = rows[(xIdx >= 0) & (xIdx < nx) & (yIdx >= 0) & (yIdx < ny)]
+                blocks += [rows]
+            remainder = data[end:]
+
+    rows = np.concatenate(blocks) if len(blocks) != 0 else np.zeros((0, 3))
+    return rows[:, 0].copy(), rows[:, 1].copy(), rows[:, 2].copy()
+
 class PPSHitmap:
     map: dict
     maxFluence: dict
@@ -17,7 +81,11 @@ class PPSHitmap:
                  yStep = 0.00005, # in m
                  betastar = 0.15,
                  verbose = False,
-                 addBackgroundFlux = None
+                 addBackgroundFlux = None,
+                 cache = False, # Keep the parsed grid and the validation results in a binary file next to the map
+                 nWorkers = None, # Number of worker processes used to parse the map file, None to parse it in this process
+                 cropWindow = False, # Only keep the entries inside the xMin to xMax, yMin to yMax window when loading the file
+                 tileSize = None # Keep the grid as tiles of tileSize x tileSize bins in a file next to the map, only read when used
                 ):
         self.filename = filename
         self.station = station
@@ -43,7 +111,24 @@ class PPSHitmap:
         if self.physics and self.calib:
             raise Exception("File {} has both physics and calibration set to true".format(self.filename))
 
-        self.map = {}
+        self.cache = cache
+        self.cacheFilename = "{}.cache.npz".format(filename)
+        self.nWorkers = nWorkers
+        self.cropWindow = cropWindow
+        self.tileSize = tileSize
+        self.tileFilename = "{}.tiles.npy".format(filename)
+        self.tileHeaderFilename = "{}.tiles.json".format(filename)
+        self._fileHash = None
+        self._integral = None # Summed-area table of the grid, built on first use
+        self._blocks = None # Block max/min tables of the grid, built on first use
+        self._pyramid = None # Coarser copies of the hitmap, see pyramidLevel()
+        self._map = {}
+        self.grid = None # 2D array of fluences, indexed as [x, y]
+        self.xAxis = None # Bin centres in m
+        self.yAxis = None # Bin centres in m
+        self._xOffset = 0 # Grid index of the bin at xMin
+        self._yOffset = 0 # Grid index of the bin at yMin
+        self._shared = None # Shared memory block of the grid, see publish() and attach()
 
         self.validated = False
 
@@ -61,40 +146,124 @@ class PPSHitmap:
         if self.verbose:
             print("From {} to {} every {}: Range of {} in {} steps (x-axis)".format(self.xMin, self.xMax, self.xStep, self.xMax - self.xMin, ((self.xMax - self.xMin)/self.xStep)))
             print("From {} to {} every {}: Range of {} in {} steps (y-axis)".format(self.yMin, self.yMax, self.yStep, self.yMax - self.yMin, ((self.yMax - self.yMin)/self.yStep)))
-        edgeIdx = int((self.detectorEdge - self.xMin)/self.xStep)
-        self.maxFluence = {}
-        self.ridge = {}
-        for xIdx in range(int((self.xMax - self.xMin)/self.xStep)):
-            xVal = round(self.xMin + xIdx*self.xStep, 6)
-            for yIdx in range(int((self.yMax - self.yMin)/self.yStep)):
-                yVal = round(self.yMin + yIdx*self.yStep, 6)
-
-                if not (xVal in self.map and yVal in self.map[xVal]):
-                    raise Exception("Did not find a fluence entry for {} for x={}, y={}".format(self.filename, xVal, yVal))
-
-                if xIdx >= edgeIdx:
-                    if ("x" not in self.maxFluence) or (self.map[xVal][yVal] > self.maxFluence["fluence"]):
-                        self.maxFluence = {
-                            "x": xVal,
-                            "y": yVal,
-                            "xIdx": xIdx,
-                            "yIdx": yIdx,
-                            "fluence": self.map[xVal][yVal]
-                        }
-                if (xIdx not in self.ridge) or (self.map[xVal][yVal] > self.ridge[xIdx]["fluence"]):
-                    self.ridge[xIdx] = {
-                        "x": xVal,
-                        "y": yVal,
-                        "xIdx": xIdx,
-                        "yIdx": yIdx,
-                        "fluence": self.map[xVal][yVal]
-                    }
+        import numpy as np
+
+        # A tiled grid is checked a band of tiles at a time, so it is never read into memory as a whole
+        nx, ny = self._windowBins()
+        ridgeYIdx = [np.zeros(0, dtype=np.int64)]
+        ridgeFluence = [np.zeros(0)]
+        for xStart in range(0, nx, self._bandBins(nx)):
+            window = self._windowGrid(xStart, min(xStart + self._bandBins(nx), nx))
+
+            missing = np.isnan(window)
+            if missing.any():
+                xIdx, yIdx = np.argwhere(missing)[0]
+                xIdx += xStart
+                raise Exception("Did not find a fluence entry for {} for x={}, y={}".format(self.filename, round(self.xMin + xIdx*self.xStep, 6), round(self.yMin + yIdx*self.yStep, 6)))
+
+            if window.size != 0:
+                ridgeYIdx += [window.argmax(axis=1)]
+                ridgeFluence += [window.max(axis=1)]
+
+        self._setRidge(np.concatenate(ridgeYIdx), np.concatenate(ridgeFluence))
         self.validated = True
         #self._freeMap()
 
+        if self.tileSize is not None:
+            self._saveTileHeader()
+        elif self.cache:
+            self._saveCache()
+
         if self.verbose and "x" in self.maxFluence:
             print("Max fluence at x={}, y={}, fluence={}".format(self.maxFluence["x"], self.maxFluence["y"], self.maxFluence["fluence"]))
-            print("Pad edge at x={}".format(edgeIdx * self.xStep + self.xMin))
+            print("Pad edge at x={}".format(int((self.detectorEdge - self.xMin)/self.xStep) * self.xStep + self.xMin))
+
+    def _windowGrid(self, xStart = 0, xStop = None):
+        """
+        Fluence in the configured window, indexed from xMin and yMin, missing entries are NaN
+        Only the x bins [xStart, xStop) of the window are returned, by default all of them
+        """
+        import numpy as np
+
+        nx, ny = self._windowBins()
+        xStop = nx if xStop is None else xStop
+        window = np.full((xStop - xStart, ny), np.nan)
+
+        xLow = max(xStart, -self._xOffset)
+        xHigh = min(xStop, self.grid.shape[0] - self._xOffset)
+        yLow = max(0, -self._yOffset)
+        yHigh = min(ny, self.grid.shape[1] - self._yOffset)
+        if xLow < xHigh and yLow < yHigh:
+            window[xLow - xStart:xHigh - xStart, yLow:yHigh] = self.grid[xLow + self._xOffset:xHigh + self._xOffset,
+                                                                        yLow + self._yOffset:yHigh + self._yOffset]
+        return window
+
+    def _bandBins(self, length):
+        """Number of x bins to process at once out of length, a tile for a tiled grid and everything otherwise"""
+        from .TiledGrid import TiledGrid
+
+        if isinstance(self.grid, TiledGrid):
+            return self.grid.tileSize
+        return max(1, length)
+
+    def _windowBins(self):
+        """Number of bins of the configured window along x and y"""
+        return int((self.xMax - self.xMin)/self.xStep), int((self.yMax - self.yMin)/self.yStep)
+
+    def _setRidge(self, ridgeYIdx, ridgeFluence):
+        """
+        ridgeYIdx and ridgeFluence hold the position and value of the maximum of every column of the window
+        The suffix maximum over the columns turns finding maxFluence for any detector edge into a lookup
+        """
+        import numpy as np
+
+        self._ridgeYIdx = ridgeYIdx
+        self._ridgeFluence = ridgeFluence
+
+        self.ridge = {}
+        for xIdx, (yIdx, fluence) in enumerate(zip(ridgeYIdx.tolist(), ridgeFluence.tolist())):
+            self.ridge[xIdx] = {
+                "x": round(self.xMin + xIdx*self.xStep, 6),
+                "y": round(self.yMin + yIdx*self.yStep, 6),
+                "xIdx": xIdx,
+                "yIdx": yIdx,
+                "fluence": fluence
+            }
+
+        # For every column, the largest fluence from that column on and the first column where it is found
+        self._suffixMax = np.maximum.accumulate(ridgeFluence[::-1])[::-1]
+        candidates = np.where(ridgeFluence == self._suffixMax, np.arange(len(ridgeFluence)), len(ridgeFluence))
+        self._suffixIdx = np.minimum.accumulate(candidates[::-1])[::-1]
+
+        self.maxFluence = self.getMaxFluence()
+
+    def getMaxFluence(self, detectorEdge = None):
+        """
+        detectorEdge in m, defaults to the current detector edge
+        Returns the maximum fluence of the map at or beyond the detector edge
+        """
+        if detectorEdge is None:
+            detectorEdge = self.detectorEdge
+
+        edgeIdx = max(int((detectorEdge - self.xMin)/self.xStep), 0)
+        if edgeIdx >= len(self._suffixIdx):
+            return {}
+
+        xIdx = int(self._suffixIdx[edgeIdx])
+        yIdx = int(self._ridgeYIdx[xIdx])
+        return {
+            "x": round(self.xMin + xIdx*self.xStep, 6),
+            "y": round(self.yMin + yIdx*self.yStep, 6),
+            "xIdx": xIdx,
+            "yIdx": yIdx,
+            "fluence": float(self._ridgeFluence[xIdx])
+        }
+
+    def setDetectorEdge(self, approximateDetectorEdge):
+        """approximateDetectorEdge in mm, as in the constructor"""
+        self.detectorEdge = approximateDetectorEdge/1000
+        if self.validated:
+            self.maxFluence = self.getMaxFluence()
 
     def _checkValid(self):
         self._checkMap()
@@ -105,27 +274,406 @@ class PPSHitmap:
             if not self.validated:
                 raise Exception("There was a problem validating the file {}".format(self.filename))
 
+    @property
+    def map(self):
+        """
+        Read only {x: {y: fluence}} view of the grid (see MapView), columns are only built when accessed
+        Assign a whole new dict to change the fluences, the grid is rebuilt from it
+        """
+        from .MapView import MapView
+
+        if self.grid is None:
+            return self._map # Not loaded yet, or a new map waiting to become the grid
+        if not isinstance(self._map, MapView) or self._map.grid is not self.grid:
+            self._map = MapView(self.grid, self.xAxis, self.yAxis)
+        return self._map
+
+    @map.setter
+    def map(self, value):
+        self._map = value
+        if len(value) != 0:
+            self.grid = None # The grid is rebuilt from the new map when needed
+
     def _checkMap(self):
-        if len(self.map) == 0:
-            self._loadMap()
+        if self.grid is None:
+            if len(self._map) == 0:
+                self._loadMap()
+            else:
+                self._gridFromMap()
 
     def _loadMap(self):
-        self.map = {}
-        with open(self.filename) as file:
-            for line in file:
-                # Units are in m and fix type
-                pLine = [float(x) for x in line.rstrip().split(' ')]
+        import os
+
+        if self.tileSize is not None:
+            if self._loadTiles():
+                return
+        elif self.cache and self._loadCache():
+            return
+
+        window = None
+        if self.cropWindow:
+            nx, ny = self._windowBins()
+            window = (self.xMin, self.xStep, nx, self.yMin, self.yStep, ny)
+
+        # Units are in m, the file is parsed in byte ranges that start at a line
+        if self.nWorkers is not None and self.nWorkers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            ranges = _lineChunks(self.filename, 4*self.nWorkers)
+            with ProcessPoolExecutor(self.nWorkers) as pool:
+                chunks = list(pool.map(_parseChunk, [self.filename]*len(ranges), *zip(*ranges), [window]*len(ranges)))
+        else:
+            chunks = [_parseChunk(self.filename, 0, os.path.getsize(self.filename), window)]
+
+        if self.addBackgroundFlux is not None:
+            for xVals, yVals, fluences in chunks:
+                fluences += self.addBackgroundFlux
+
+        self._setGridChunks(chunks)
+        del chunks
+
+        self._map = {}
+        if self.tileSize is not None:
+            self._saveTiles()
+            return
+
+        if self.cache:
+            self._saveCache()
+
+    def _cacheKey(self):
+        """Identifies the source file and the options used when parsing it"""
+        import hashlib
+        import os
+
+        stat = os.stat(self.filename)
+        # Only hash the file again if it changed since the last time we looked at it
+        if self._fileHash is None or self._fileHash[:2] != (stat.st_size, stat.st_mtime_ns):
+            digest = hashlib.sha256()
+            with open(self.filename, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 24), b''):
+                    digest.update(chunk)
+            self._fileHash = (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+
+        return {
+            "version": 2,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sha256": self._fileHash[2],
+            "addBackgroundFlux": self.addBackgroundFlux,
+            "window": self._validationKey() if self.cropWindow else None,
+        }
+
+    def _validationKey(self):
+        """The validation results are only valid for the same window"""
+        return [self.xMin, self.xMax, self.xStep, self.yMin, self.yMax, self.yStep]
+
+    def _loadCache(self):
+        import json
+        import os
+        import numpy as np
+
+        if not os.path.exists(self.cacheFilename):
+            return False
+
+        try:
+            with np.load(self.cacheFilename, allow_pickle=False) as data:
+                header = json.loads(str(data["header"]))
+                if header["key"] != self._cacheKey():
+                    return False
+                self.grid = data["grid"]
+                self.xAxis = data["xAxis"]
+                self.yAxis = data["yAxis"]
+                if header["validation"] is not None and header["validation"]["key"] == self._validationKey():
+                    ridgeYIdx = data["ridgeYIdx"]
+                    ridgeFluence = data["ridgeFluence"]
+                else:
+                    ridgeYIdx = None
+        except (OSError, ValueError, KeyError) as e:
+            if self.verbose:
+                print("Ignoring the cache {} for {}: {}".format(self.cacheFilename, self.filename, e))
+            return False
 
-                if pLine[0] not in self.map:
-                    self.map[pLine[0]] = {}
+        self._xOffset = -int(np.rint((self.xAxis[0] - self.xMin)/self.xStep))
+        self._yOffset = -int(np.rint((self.yAxis[0] - self.yMin)/self.yStep))
+
+        self._map = {}
+
+        if ridgeYIdx is not None:
+            self._setRidge(ridgeYIdx, ridgeFluence)
+            self.validated = True
+
+        if self.verbose:
+            print("Loaded {} from the cache {}".format(self.filename, self.cacheFilename))
+        return True
+
+    def _saveCache(self):
+        import json
+        import os
+        import numpy as np
+
+        header = {"key": self._cacheKey(), "validation": None}
+        ridgeYIdx = np.zeros(0, dtype=np.int64)
+        ridgeFluence = np.zeros(0)
+        if self.validated:
+            header["validation"] = {"key": self._validationKey()}
+            ridgeYIdx = self._ridgeYIdx
+            ridgeFluence = self._ridgeFluence
+
+        # Write to a temporary file first, so an interrupted session never leaves a broken cache behind
+        tmpFilename = "{}.tmp".format(self.cacheFilename)
+        with open(tmpFilename, 'wb') as file:
+            np.savez(file,
+                     header=np.array(json.dumps(header)),
+                     grid=self.grid,
+                     xAxis=self.xAxis,
+                     yAxis=self.yAxis,
+                     ridgeYIdx=ridgeYIdx,
+                     ridgeFluence=ridgeFluence)
+        os.replace(tmpFilename, self.cacheFilename)
+
+    def _tileKey(self):
+        key = self._cacheKey()
+        key["tileSize"] = self.tileSize
+        return key
+
+    def _loadTiles(self):
+        import json
+        import os
+        import numpy as np
+        from .TiledGrid import TiledGrid
+
+        if not os.path.exists(self.tileFilename) or not os.path.exists(self.tileHeaderFilename):
+            return False
+
+        try:
+            with open(self.tileHeaderFilename) as file:
+                header = json.load(file)
+            if header["key"] != self._tileKey():
+                return False
+            grid = TiledGrid(self.tileFilename, header["shape"])
+            if grid.tiles.shape[2] != self.tileSize:
+                return False
+        except (OSError, ValueError, KeyError) as e:
+            if self.verbose:
+                print("Ignoring the tiles {} for {}: {}".format(self.tileFilename, self.filename, e))
+            return False
+
+        self.grid = grid
+        self.xAxis = np.array(header["xAxis"], dtype=np.float64)
+        self.yAxis = np.array(header["yAxis"], dtype=np.float64)
+        self._xOffset = -int(np.rint((self.xAxis[0] - self.xMin)/self.xStep))
+        self._yOffset = -int(np.rint((self.yAxis[0] - self.yMin)/self.yStep))
+        self._map = {}
+
+        validation = header["validation"]
+        if validation is not None and validation["key"] == self._validationKey():
+            self._setRidge(np.array(validation["ridgeYIdx"], dtype=np.int64), np.array(validation["ridgeFluence"], dtype=np.float64))
+            self.validated = True
 
-                self.map[pLine[0]][pLine[1]] = pLine[2]
-                if self.addBackgroundFlux is not None:
-                    self.map[pLine[0]][pLine[1]] += self.addBackgroundFlux
+        if self.verbose:
+            print("Loaded {} from the tiles {}".format(self.filename, self.tileFilename))
+        return True
+
+    def _saveTiles(self):
+        """Writes the grid as tiles and swaps it for the memory mapped TiledGrid"""
+        import os
+        from .TiledGrid import TiledGrid
+
+        # Write to a temporary file first, so an interrupted session never leaves broken tiles behind
+        tmpFilename = "{}.tmp".format(self.tileFilename)
+        TiledGrid.save(tmpFilename, self.grid, self.tileSize)
+        os.replace(tmpFilename, self.tileFilename)
+
+        self.grid = TiledGrid(self.tileFilename, self.grid.shape)
+        self._map = {}
+        self._saveTileHeader()
+
+    def _saveTileHeader(self):
+        import json
+        import os
+
+        header = {
+            "key": self._tileKey(),
+            "shape": list(self.grid.shape),
+            "xAxis": self.xAxis.tolist(),
+            "yAxis": self.yAxis.tolist(),
+            "validation": None,
+        }
+        if self.validated:
+            header["validation"] = {
+                "key": self._validationKey(),
+                "ridgeYIdx": self._ridgeYIdx.tolist(),
+                "ridgeFluence": self._ridgeFluence.tolist(),
+            }
+
+        tmpFilename = "{}.tmp".format(self.tileHeaderFilename)
+        with open(tmpFilename, 'w') as file:
+            json.dump(header, file)
+        os.replace(tmpFilename, self.tileHeaderFilename)
+
+    def _setGrid(self, xVals, yVals, fluences):
+        """Scatter the (x, y, fluence) columns into the dense grid, missing entries are left as NaN"""
+        self._setGridChunks([(xVals, yVals, fluences)])
+
+    def _setGridChunks(self, chunks):
+        """
+        Scatter the (x, y, fluence) columns of every chunk into the dense grid, missing entries are left as NaN
+        Later entries of the same bin win, as when reading the file in order
+        """
+        import numpy as np
+
+        chunks = [chunk for chunk in chunks if len(chunk[2]) != 0]
+        if len(chunks) == 0:
+            raise Exception("Did not find any fluence entry in {}".format(self.filename))
+
+        indices = [(np.rint((xVals - self.xMin)/self.xStep).astype(np.int64), np.rint((yVals - self.yMin)/self.yStep).astype(np.int64)) for xVals, yVals, fluences in chunks]
+        self._xOffset = -min(int(xIdx.min()) for xIdx, yIdx in indices)
+        self._yOffset = -min(int(yIdx.min()) for xIdx, yIdx in indices)
+        nx = max(int(xIdx.max()) for xIdx, yIdx in indices) + self._xOffset + 1
+        ny = max(int(yIdx.max()) for xIdx, yIdx in indices) + self._yOffset + 1
+
+        self.grid = np.full((nx, ny), np.nan)
+        self.xAxis = self.xMin + (np.arange(nx) - self._xOffset)*self.xStep
+        self.yAxis = self.yMin + (np.arange(ny) - self._yOffset)*self.yStep
+        for (xVals, yVals, fluences), (xIdx, yIdx) in zip(chunks, indices):
+            xIdx += self._xOffset
+            yIdx += self._yOffset
+            self.grid[xIdx, yIdx] = fluences
+
+            # Keep the coordinates exactly as found in the file, so the map view has the same keys as before
+            self.xAxis[xIdx] = xVals
+            self.yAxis[yIdx] = yVals
+
+    def _gridFromMap(self):
+        import numpy as np
+
+        xVals = [x for x in self._map for y in self._map[x]]
+        yVals = [y for x in self._map for y in self._map[x]]
+        fluences = [self._map[x][y] for x in self._map for y in self._map[x]]
+        self._setGrid(np.array(xVals, dtype=np.float64), np.array(yVals, dtype=np.float64), np.array(fluences, dtype=np.float64))
+        self._map = {} # The grid is the only copy from now on, map becomes a view of it
+
+    def _hasFluence(self, xIdx, yIdx):
+        """xIdx and yIdx are bin indices counted from xMin and yMin"""
+        i = xIdx + self._xOffset
+        j = yIdx + self._yOffset
+        if i < 0 or j < 0 or i >= self.grid.shape[0] or j >= self.grid.shape[1]:
+            return False
+        return self.grid[i, j] == self.grid[i, j] # NaN marks a missing entry
+
+    def _fluence(self, xIdx, yIdx):
+        """xIdx and yIdx are bin indices counted from xMin and yMin"""
+        if not self._hasFluence(xIdx, yIdx):
+            raise KeyError("Did not find a fluence entry for {} for x={}, y={}".format(self.filename, round(self.xMin + xIdx*self.xStep, 6), round(self.yMin + yIdx*self.yStep, 6)))
+        return float(self.grid[xIdx + self._xOffset, yIdx + self._yOffset])
 
     def _freeMap(self):
-        if len(self.map) != 0:
-            self.map = {}
+        if len(self._map) != 0 or self.grid is not None:
+            self._map = {}
+            self.grid = None
+
+    def publish(self):
+        """
+        Copies the grid, its summed-area table and the block max/min tables built so far to a shared memory block
+        that other processes can attach to with PPSHitmap.attach(spec), so they never rebuild them. Run the queries
+        once in this process first (e.g. calculateFlux) so the block tables they need exist when publishing
+        Returns spec, a small picklable dict. The block lives until unpublish() is called, call it once all
+        the attached processes are done
+        """
+        import copy
+        import numpy as np
+        from multiprocessing import shared_memory
+
+        if self._shared is not None:
+            if not self._shared['owner']:
+                raise RuntimeError("Hitmap {} is attached to a shared grid, only its owner can publish it".format(self.filename))
+            return self._shared['spec']
+
+        self._checkMap()
+
+        # Tiled tables are read in full here, the shared block holds them all anyway
+        tables = [('grid', np.asarray(self.grid)), ('integral', np.asarray(self._integralImage()))]
+        if self._blocks is not None and self._blocks[0] is self.grid:
+            tables += [(('block',) + key, np.asarray(block)) for key, block in self._blocks[1].items()]
+
+        # All the tables are float64, so every offset stays aligned
+        layout = []
+        offset = 0
+        for key, table in tables:
+            layout += [(key, table.shape, table.dtype.str, offset)]
+            offset += table.nbytes
+
+        shm = shared_memory.SharedMemory(create=True, size=max(1, offset))
+        for (key, table), (_, shape, dtype, start) in zip(tables, layout):
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)[...] = table
+
+        # Everything but the large arrays, which the attached processes read from the block
+        state = copy.copy(self)
+        state._map = {}
+        state.grid = None
+        state._integral = None
+        state._blocks = None
+        state._pyramid = None
+        state._shared = None
+
+        spec = {'name': shm.name, 'tables': layout, 'hitmap': state}
+        self._shared = {'shm': shm, 'spec': spec, 'owner': True}
+
+        return spec
+
+    def unpublish(self):
+        """Releases the shared memory block created by publish(), this hitmap keeps its own grid"""
+        if self._shared is None or not self._shared['owner']:
+            return
+
+        self._shared['shm'].close()
+        self._shared['shm'].unlink()
+        self._shared = None
+
+    @staticmethod
+    def attach(spec):
+        """
+        Read only hitmap on the grid and tables published by another process, without copying them
+        Block tables that were not published are still built privately when a query needs them
+        Call detach() once done with it, the grid can not be used afterwards
+        """
+        import copy
+        import numpy as np
+        from multiprocessing import shared_memory
+
+        try:
+            shm = shared_memory.SharedMemory(name=spec['name'], track=False) # Only the owner cleans the block up
+        except TypeError:
+            # Before python 3.13 the block is tracked anyway, which is harmless in processes started by the owner
+            shm = shared_memory.SharedMemory(name=spec['name'])
+
+        tables = {}
+        for key, shape, dtype, offset in spec['tables']:
+            table = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            table.flags.writeable = False
+            tables[key] = table
+
+        hitmap = copy.copy(spec['hitmap'])
+        hitmap.grid = tables.pop('grid')
+        hitmap._integral = (hitmap.grid, tables.pop('integral'))
+        hitmap._blocks = (hitmap.grid, {key[1:]: table for key, table in tables.items()})
+        hitmap._shared = {'shm': shm, 'spec': spec, 'owner': False}
+
+        return hitmap
+
+    def detach(self):
+        """Closes the shared grid of a hitmap from attach(), the block itself stays until its owner unpublishes it"""
+        if self._shared is None or self._shared['owner']:
+            return
+
+        shm = self._shared['shm']
+        self._shared = None
+        self._map = {}
+        self.grid = None
+        self._integral = None
+        self._blocks = None
+        self._pyramid = None
+        shm.close()
 
     def getHisto(self, name, title):
         self._checkValid()
@@ -158,7 +706,7 @@ class PPSHitmap:
             xVal = round(self.xMin + xIdx*self.xStep, 6)
             for yIdx in range(int((self.yMax - self.yMin)/self.yStep)):
                 yVal = round(self.yMin + yIdx*self.yStep, 6)
-                hist.SetBinContent(hist.FindBin(xVal*1000, yVal*1000), self.map[xVal][yVal])
+                hist.SetBinContent(hist.FindBin(xVal*1000, yVal*1000), self._fluence(xIdx, yIdx))
 
         return hist
 
@@ -177,47 +725,347 @@ class PPSHitmap:
         """xLen and yLen in m"""
         self._checkValid()
 
-        from math import ceil, floor
-
         # Convert Phi 1fb-1 to Phi BX - multiply by 1.6 x 10^-12 Phi in units of particles/cm^2 Occupancy in units
         # of particles
 
-        xBins = ceil(xLen/self.xStep)
-        yBins = ceil(yLen/self.yStep * 0.5 - 0.5) * 2 + 1  # The pad is centered on the bin of max fluence, so we need to adjust things around
-        minY = self.maxFluence["yIdx"] - floor(yBins/2)
-        maxY = self.maxFluence["yIdx"] + floor(yBins/2)
-
+        # The pad starts at the left edge of the bin of max fluence and is centered on it in y
         leftPad = self.maxFluence["x"] - self.xStep/2
         rightPad = self.maxFluence["x"] - self.xStep/2 + xLen
         bottomPad = self.maxFluence["y"] - yLen/2
         topPad = self.maxFluence["y"] + yLen/2
 
-        fluence = 0
-        for xIdx in range(self.maxFluence["xIdx"], self.maxFluence["xIdx"] + xBins):
-            xVal = round(self.xMin + xIdx*self.xStep, 6)
-            for yIdx in range(minY, maxY + 1):
-                yVal = round(self.yMin + yIdx*self.yStep, 6)
-                left = xVal - self.xStep/2
-                right = xVal + self.xStep/2
-                bottom = yVal - self.yStep/2
-                top = yVal + self.yStep/2
-
-                contributionX = 1
-                if right > rightPad:
-                    contributionX -= (right - rightPad)/self.xStep
-                if left < leftPad:
-                    contributionX -= (left - leftPad)/self.xStep
-
-                contributionY = 1
-                if top > topPad:
-                    contributionY -= (top - topPad)/self.yStep
-                if bottom < bottomPad:
-                    contributionY -= (bottomPad - bottom)/self.yStep
-                fluence += self.map[xVal][yVal] * contributionX * contributionY
+        fluence = self.integrateRect(leftPad, rightPad, bottomPad, topPad)
 
         occupancy = fluence * 1.6E-12 * (self.xStep * self.yStep) * 1.0E4
         return occupancy
 
+    def pyramidLevel(self, level):
+        """
+        Copy of the hitmap with bins of 2**level x 2**level bins of this one, level 0 is the hitmap itself
+        The fluence of a coarse bin is the mean of its bins, missing bins counting as 0, so integrals over areas
+        aligned with the coarse bins are unchanged. The coarse bins start at the bin of xMin and yMin
+        The levels are kept until the grid changes
+        """
+        import copy
+        import numpy as np
+
+        if level < 0:
+            raise ValueError("The pyramid level must be 0 or more, got {}".format(level))
+        if level == 0:
+            return self
+
+        self._checkMap()
+        if self._pyramid is None or self._pyramid[0] is not self.grid:
+            self._pyramid = (self.grid, {})
+        levels = self._pyramid[1]
+
+        if level not in levels:
+            factor = 2**level
+            shape = self.grid.shape
+
+            # Pad the grid with missing bins, so the bin of xMin and yMin starts a coarse bin
+            xOffset = -(-self._xOffset//factor)
+            yOffset = -(-self._yOffset//factor)
+            xBefore = xOffset*factor - self._xOffset
+            yBefore = yOffset*factor - self._yOffset
+            nx = -(-(shape[0] + xBefore)//factor)
+            ny = -(-(shape[1] + yBefore)//factor)
+
+            # One band of coarse bins at a time, a tiled grid is never read into memory as a whole
+            coarseGrid = np.empty((nx, ny))
+            band = -(-self._bandBins(nx*factor)//factor)
+            for xStart in range(0, nx, band):
+                xStop = min(xStart + band, nx)
+                padded = np.full(((xStop - xStart)*factor, ny*factor), np.nan)
+                gridStart = max(xStart*factor - xBefore, 0)
+                gridStop = min(xStop*factor - xBefore, shape[0])
+                if gridStart < gridStop:
+                    padded[gridStart + xBefore - xStart*factor:gridStop + xBefore - xStart*factor, yBefore:yBefore + shape[1]] = self.grid[gridStart:gridStop, :]
+
+                blocks = padded.reshape(xStop - xStart, factor, ny, factor)
+                coarseBand = np.nansum(blocks, axis=(1, 3))/factor**2
+                coarseBand[np.isnan(blocks).all(axis=(1, 3))] = np.nan
+                coarseGrid[xStart:xStop] = coarseBand
+
+            coarse = copy.copy(self)
+            coarse.xStep = self.xStep*factor
+            coarse.yStep = self.yStep*factor
+            coarse.xMin = self.xMin + (factor - 1)/2*self.xStep
+            coarse.yMin = self.yMin + (factor - 1)/2*self.yStep
+            # Round the window up to whole coarse bins
+            windowX, windowY = self._windowBins()
+            coarse.xMax = coarse.xMin + (-(-windowX//factor) + 0.5)*coarse.xStep
+            coarse.yMax = coarse.yMin + (-(-windowY//factor) + 0.5)*coarse.yStep
+
+            coarse.grid = coarseGrid
+            coarse.xAxis = coarse.xMin + (np.arange(nx) - xOffset)*coarse.xStep
+            coarse.yAxis = coarse.yMin + (np.arange(ny) - yOffset)*coarse.yStep
+            coarse._xOffset = xOffset
+            coarse._yOffset = yOffset
+
+            # Never write the coarse grid over the caches of the map file
+            coarse.cache = False
+            coarse.tileSize = None
+            coarse._map = {}
+            coarse._integral = None
+            coarse._blocks = None
+            coarse._pyramid = None
+            coarse._shared = None
+            coarse.validated = False
+            if self.validated:
+                coarse.validate()
+
+            levels[level] = coarse
+
+        return levels[level]
+
+    def _placementCandidates(self, first, step, bins, low, high, length):
+        """
+        Pad start positions along one axis, in m, where the start or the end of the pad is on a bin edge, plus the
+        ends of the allowed range. Between them the integral is bilinear in the position, so its extremes are there
+        """
+        import numpy as np
+
+        edges = first + (np.arange(bins + 1) - 0.5)*step
+        candidates = np.concatenate([edges, edges - length, [low, high - length]])
+        candidates = candidates[(candidates >= low) & (candidates <= high - length)]
+        return np.unique(candidates)
+
+    def padPlacementSearch(self, xLen, yLen, detectorEdge = None, chunkSize = 1 << 22):
+        """
+        xLen and yLen in m, detectorEdge in m, defaults to the current detector edge
+        Slides a pad of xLen by yLen over the window beyond the detector edge and finds the exact maximum and
+        minimum of its integrated occupancy, computed as in integratePadOccupancy, whose pad is one of the positions
+        Returns ((maxOccupancy, x, y), (minOccupancy, x, y)) with the position of the pad centre in m
+        """
+        import numpy as np
+
+        self._checkValid()
+
+        if detectorEdge is None:
+            detectorEdge = self.detectorEdge
+
+        # The allowed region starts at the left edge of the bin of the detector edge, as for getMaxFluence
+        nx, ny = self._windowBins()
+        edgeIdx = max(int((detectorEdge - self.xMin)/self.xStep), 0)
+        xLow = self.xMin + (edgeIdx - 0.5)*self.xStep
+        xHigh = self.xMin + (nx - 0.5)*self.xStep
+        yLow = self.yMin - self.yStep/2
+        yHigh = self.yMin + (ny - 0.5)*self.yStep
+        if xHigh - xLow < xLen or yHigh - yLow < yLen:
+            raise ValueError("A pad of {} by {} m does not fit in the window beyond the detector edge".format(xLen, yLen))
+
+        xStarts = self._placementCandidates(self.xMin, self.xStep, nx, xLow, xHigh, xLen)
+        yStarts = self._placementCandidates(self.yMin, self.yStep, ny, yLow, yHigh, yLen)
+
+        best = {"max": (-np.inf, None, None), "min": (np.inf, None, None)}
+        # Evaluate the (x, y) candidates in chunks of x positions to bound the memory used
+        step = max(1, chunkSize//len(yStarts))
+        for start in range(0, len(xStarts), step):
+            x0 = xStarts[start:start+step, None]
+            fluence = self.integrateRect(x0, x0 + xLen, yStarts[None, :], yStarts[None, :] + yLen)
+            for reduce, better in (("max", np.greater), ("min", np.less)):
+                idx = np.unravel_index(fluence.argmax() if reduce == "max" else fluence.argmin(), fluence.shape)
+                if better(fluence[idx], best[reduce][0]):
+                    best[reduce] = (float(fluence[idx]), float(x0[idx[0], 0] + xLen/2), float(yStarts[idx[1]] + yLen/2))
+
+        scale = 1.6E-12 * (self.xStep * self.yStep) * 1.0E4
+        return tuple((best[reduce][0] * scale, best[reduce][1], best[reduce][2]) for reduce in ("max", "min"))
+
+    def _padOccupancy(self, xLen, yLen, method):
+        """Occupancy of pads of xLen by yLen m, arrays that broadcast together, NaN without a maximum fluence"""
+        import numpy as np
+
+        self._checkValid()
+
+        xLen = np.asarray(xLen, dtype=np.float64)
+        yLen = np.asarray(yLen, dtype=np.float64)
+        if "fluence" not in self.maxFluence:
+            return np.full(np.broadcast(xLen, yLen).shape, np.nan)
+
+        if method == "peakUniform":
+            return self.maxFluence["fluence"] * 1.6E-12 * (xLen * yLen) * 1.0E4 + np.zeros(np.broadcast(xLen, yLen).shape)
+        if method == "integrate":
+            # Same pads as integratePadOccupancy, starting at the left edge of the bin of max fluence and centred on it in y
+            leftPad = self.maxFluence["x"] - self.xStep/2
+            rightPad = self.maxFluence["x"] - self.xStep/2 + xLen
+            bottomPad = self.maxFluence["y"] - yLen/2
+            topPad = self.maxFluence["y"] + yLen/2
+
+            fluence = np.asarray(self.integrateRect(leftPad, rightPad, bottomPad, topPad))
+            return fluence * 1.6E-12 * (self.xStep * self.yStep) * 1.0E4
+        raise ValueError("Unknown pad occupancy method {}".format(method))
+
+    def padSizeScan(self, xLens, yLens, method = "integrate", grid = True, level = 0, refine = None):
+        """
+        xLens and yLens - pad sizes in m
+        method - "integrate" as integratePadOccupancy or "peakUniform" as peakUniformPadOccupancy
+        grid - with True the occupancy of every (xLen, yLen) pair, of shape (len(xLens), len(yLens)), otherwise
+               xLens and yLens broadcast together
+        level - evaluate on pyramidLevel(level)
+        refine - number of the largest occupancies of a coarse level to recompute at full resolution
+        Returns the array of occupancies, computed at once from the summed-area table, NaN without a maximum fluence
+        """
+        import numpy as np
+
+        xLens = np.asarray(xLens, dtype=np.float64)
+        yLens = np.asarray(yLens, dtype=np.float64)
+        if grid:
+            xLens, yLens = np.meshgrid(xLens.ravel(), yLens.ravel(), indexing='ij')
+        xLens, yLens = np.broadcast_arrays(xLens, yLens)
+
+        occupancy = self.pyramidLevel(level)._padOccupancy(xLens, yLens, method)
+        if level != 0 and refine is not None and refine > 0:
+            occupancy = occupancy.reshape(-1)
+            top = np.argsort(np.where(np.isnan(occupancy), -np.inf, occupancy))[::-1][:refine]
+            occupancy[top] = self._padOccupancy(xLens.reshape(-1)[top], yLens.reshape(-1)[top], method)
+            occupancy = occupancy.reshape(xLens.shape)
+
+        return occupancy
+
+    def _integralImage(self):
+        """Summed-area table of the grid, entry [i, j] is the sum of all bins below i in x and below j in y"""
+        import numpy as np
+
+        from .TiledGrid import TiledGrid
+
+        if self._integral is None or self._integral[0] is not self.grid:
+            if isinstance(self.grid, TiledGrid):
+                # Streamed to its own tiles, entries are read back on demand like the grid
+                integral = self._tiledTable("sat", (self.grid.shape[0] + 1, self.grid.shape[1] + 1), self.grid.summedArea)
+            else:
+                integral = np.zeros((self.grid.shape[0] + 1, self.grid.shape[1] + 1))
+                np.cumsum(np.nan_to_num(self.grid), axis=0, out=integral[1:, 1:])
+                np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+            self._integral = (self.grid, integral)
+
+        return self._integral[1]
+
+    def _tiledTable(self, name, shape, build):
+        """
+        Table derived from the tiled grid, stored as tiles in its own file next to the grid tiles
+        The file is reused while it is newer than the grid tiles, otherwise build(filename) writes it and returns it
+        """
+        import os
+        from .TiledGrid import TiledGrid
+
+        filename = "{}.tiles.{}.npy".format(self.filename, name)
+        if os.path.exists(filename) and os.path.getmtime(filename) >= os.path.getmtime(self.tileFilename):
+            table = TiledGrid(filename, shape, maxTiles=self.grid.maxTiles)
+            try:
+                if table.tiles.shape == (-(-shape[0]//self.tileSize), -(-shape[1]//self.tileSize), self.tileSize, self.tileSize):
+                    return table
+            except (OSError, ValueError) as e:
+                if self.verbose:
+                    print("Ignoring the tiles {} for {}: {}".format(filename, self.filename, e))
+
+        # Write to a temporary file first, so an interrupted session never leaves broken tiles behind
+        tmpFilename = "{}.tmp".format(filename)
+        build(tmpFilename)
+        os.replace(tmpFilename, filename)
+        return TiledGrid(filename, shape, maxTiles=self.grid.maxTiles)
+
+    def _cumulativeIntegral(self, u, v):
+        """Integral of the grid from its lower corner up to (u, v), given in bin units, with partial bins"""
+        import numpy as np
+
+        integral = self._integralImage()
+        nx = integral.shape[0] - 1
+        ny = integral.shape[1] - 1
+
+        u = np.clip(u, 0, nx)
+        v = np.clip(v, 0, ny)
+        i = np.minimum(np.floor(u).astype(np.int64), nx - 1)
+        j = np.minimum(np.floor(v).astype(np.int64), ny - 1)
+        fu = u - i
+        fv = v - j
+
+        # The integral is bilinear within a bin, so interpolating the table is exact
+        return (integral[i, j] * (1 - fu) * (1 - fv) +
+                integral[i + 1, j] * fu * (1 - fv) +
+                integral[i, j + 1] * (1 - fu) * fv +
+                integral[i + 1, j + 1] * fu * fv)
+
+    def _blockReduce(self, xPower, yPower, reduce):
+        """
+        Max (or min) of the grid over every block of 2**xPower by 2**yPower bins, NaN entries are ignored
+        Entry [i, j] covers the bins from i and j on, the tables are kept until the grid changes
+        For a tiled grid they are written next to its tiles and read on demand
+        """
+        import numpy as np
+        from .TiledGrid import TiledGrid
+
+        if self._blocks is None or self._blocks[0] is not self.grid:
+            self._blocks = (self.grid, {})
+        blocks = self._blocks[1]
+
+        key = (xPower, yPower, reduce)
+        if key not in blocks and isinstance(self.grid, TiledGrid):
+            shape = (max(0, self.grid.shape[0] - 2**xPower + 1), max(0, self.grid.shape[1] - 2**yPower + 1))
+            blocks[key] = self._tiledTable("{}-{}-{}".format(reduce, xPower, yPower), shape,
+                                           lambda filename: self.grid.blockReduce(filename, xPower, yPower, reduce))
+        elif key not in blocks:
+            op = np.fmax if reduce == "max" else np.fmin
+            block = self.grid
+            for power in range(xPower):
+                block = op(block[:-2**power], block[2**power:])
+            for power in range(yPower):
+                block = op(block[:, :-2**power], block[:, 2**power:])
+            blocks[key] = block
+
+        return blocks[key]
+
+    def _rangeReduce(self, xStart, xStop, yStart, yStop, reduce = "max"):
+        """
+        Max (or min) of the grid over the index windows [xStart, xStop) x [yStart, yStop), given as arrays
+        Every window is covered by four overlapping power of two blocks, so the cost does not depend on its size
+        Empty windows give NaN
+        """
+        import numpy as np
+
+        op = np.fmax if reduce == "max" else np.fmin
+        xStart, xStop, yStart, yStop = np.broadcast_arrays(*[np.asarray(idx, dtype=np.int64) for idx in (xStart, xStop, yStart, yStop)])
+        result = np.full(xStart.shape, np.nan)
+
+        valid = (xStop > xStart) & (yStop > yStart)
+        xPower = np.zeros(xStart.shape, dtype=np.int64)
+        yPower = np.zeros(xStart.shape, dtype=np.int64)
+        xPower[valid] = np.floor(np.log2(xStop[valid] - xStart[valid]))
+        yPower[valid] = np.floor(np.log2(yStop[valid] - yStart[valid]))
+
+        for xP, yP in set(zip(xPower[valid].tolist(), yPower[valid].tolist())):
+            sel = valid & (xPower == xP) & (yPower == yP)
+            block = self._blockReduce(xP, yP, reduce)
+            x0, y0 = xStart[sel], yStart[sel]
+            x1, y1 = xStop[sel] - 2**xP, yStop[sel] - 2**yP
+            result[sel] = op(op(block[x0, y0], block[x1, y0]), op(block[x0, y1], block[x1, y1]))
+
+        return result
+
+    def integrateRect(self, xmin, xmax, ymin, ymax):
+        """
+        Bounds in m, either numbers or arrays that broadcast together
+        Returns the sum of the fluence of the bins, each weighted by the fraction of the bin inside the rectangle
+        """
+        self._checkMap()
+
+        import numpy as np
+
+        # Position of the bounds in bin units, counted from the lower edge of the first bin of the grid
+        xEdge = self.xMin - (self._xOffset + 0.5)*self.xStep
+        yEdge = self.yMin - (self._yOffset + 0.5)*self.yStep
+        u0 = (np.asarray(xmin, dtype=np.float64) - xEdge)/self.xStep
+        u1 = (np.asarray(xmax, dtype=np.float64) - xEdge)/self.xStep
+        v0 = (np.asarray(ymin, dtype=np.float64) - yEdge)/self.yStep
+        v1 = (np.asarray(ymax, dtype=np.float64) - yEdge)/self.yStep
+
+        fluence = (self._cumulativeIntegral(u1, v1) - self._cumulativeIntegral(u0, v1) -
+                   self._cumulativeIntegral(u1, v0) + self._cumulativeIntegral(u0, v0))
+
+        if np.ndim(fluence) == 0:
+            return float(fluence)
+        return fluence
+
     def plotShifts(self, integratedLuminosity=300, padLength = 1.3, plotPadCols = 2, maxCols = 3, maxNumShifts=4, thresholdFlux = None, baseColor = None, colorOffset=3, drawOneSided=False):
         self._checkValid()
 
@@ -295,25 +1143,17 @@ class PPSHitmap:
                     fluxMed = 0
                     for i in range(nShift + 1):
                         index = -int(nShift/2) + i
-                        xVal = round(self.xMin + xIdx*self.xStep, 6)
-                        yVal = round(self.yMin + (yIdx + index*shiftIdx)*self.yStep, 6)
-                        fluxMed += self.map[xVal][yVal] * integratedLuminosity/(nShift+1)
+                        fluxMed += self._fluence(xIdx, yIdx + index*shiftIdx) * integratedLuminosity/(nShift+1)
                     yArrMed.append(fluxMed)
 
                     fluxPlus = 0
                     for i in range(nShift + 1):
-                        xVal = round(self.xMin + xIdx*self.xStep, 6)
-                        yVal = round(self.yMin + (yIdx + i*shiftIdx)*self.yStep, 6)
-                        fluxPlus += self.map[xVal][yVal] * integratedLuminosity/(nShift+1)
+                        fluxPlus += self._fluence(xIdx, yIdx + i*shiftIdx) * integratedLuminosity/(nShift+1)
                     yArrUp.append(fluxPlus)
 
                     fluxMinus = 0
                     for i in range(nShift + 1):
-                        xVal = round(self.xMin + xIdx*self.xStep, 6)
-                        yVal = round(self.yMin + (yIdx - i*shiftIdx)*self.yStep, 6)
-                        print("xVal: {}; yVal: {}; nShift: {}".format(xVal,yVal,nShift))
-                        print(self.map[xVal].keys())
-                        fluxMinus += self.map[xVal][yVal] * integratedLuminosity/(nShift+1)
+                        fluxMinus += self._fluence(xIdx, yIdx - i*shiftIdx) * integratedLuminosity/(nShift+1)
                     yArrDown.append(fluxMinus)
 
                     if minFlux is None:
@@ -380,7 +1220,7 @@ class PPSHitmap:
 
         return canv, persistance
 
-    def squarePadPeakUniformScan(self, bins, minPad, maxPad, doLog = False):
+    def _squarePadScan(self, bins, minPad, maxPad, doLog, method, level, refine):
         if bins <= 1:
             raise ValueError("You must set 2 or more bins for the bin integration")
         if doLog and minPad == 0:
@@ -388,7 +1228,6 @@ class PPSHitmap:
 
         from math import log
         padSize = []
-        occupancy = []
 
         step = (maxPad - minPad)/(bins-1)
         if doLog:
@@ -399,70 +1238,37 @@ class PPSHitmap:
                 padSize += [2**(ibin * step + log(minPad,2))]
             else:
                 padSize += [ibin * step + minPad]
-            occupancy += [self.peakUniformPadOccupancy(padSize[ibin], padSize[ibin])]
-
-        return (padSize,occupancy)
-
-    def squarePadIntegrateScan(self, bins, minPad, maxPad, doLog = False):
-        if bins <= 1:
-            raise ValueError("You must set 2 or more bins for the bin integration")
-        if doLog and minPad == 0:
-            raise ValueError("You can not set the minimum to 0 when using a logarithm scale")
-
-        from math import log
-        padSize = []
-        occupancy = []
 
-        step = (maxPad - minPad)/(bins-1)
-        if doLog:
-            step = (log(maxPad,2) - log(minPad,2))/(bins-1)
+        occupancy = self.padSizeScan(padSize, padSize, method = method, grid = False, level = level, refine = refine)
+        return (padSize, [None if occ != occ else occ for occ in occupancy.tolist()])
 
-        for ibin in range(bins):
-            if doLog:
-                padSize += [2**(ibin * step + log(minPad,2))]
-            else:
-                padSize += [ibin * step + minPad]
-            occupancy += [self.integratePadOccupancy(padSize[ibin], padSize[ibin])]
+    def squarePadPeakUniformScan(self, bins, minPad, maxPad, doLog = False, level = 0, refine = None):
+        """Pad sizes in m, see padSizeScan for level and refine"""
+        return self._squarePadScan(bins, minPad, maxPad, doLog, "peakUniform", level, refine)
 
-        return (padSize,occupancy)
+    def squarePadIntegrateScan(self, bins, minPad, maxPad, doLog = False, level = 0, refine = None):
+        """Pad sizes in m, see padSizeScan for level and refine"""
+        return self._squarePadScan(bins, minPad, maxPad, doLog, "integrate", level, refine)
 
-    def squarePadPeakUniformGraph(self, bins, minPad, maxPad, padScale = 1, doLog = False):
+    def _scanGraph(self, padSize, occupancy, padScale):
         from ROOT import TGraph  # type: ignore
-
         from array import array
-        (padSize, occupancy) = self.squarePadPeakUniformScan(bins, minPad, maxPad, doLog = doLog)
-        for ibin in range(len(padSize)):
-            padSize[ibin] = padSize[ibin] * padScale
 
         x, y = array( 'd' ), array( 'd' )
-        graph = TGraph()
-        for ibin in range(len(padSize)):
-            x.append(padSize[ibin])
-            if occupancy[ibin] is not None:
-                y.append(occupancy[ibin])
+        for pad, occ in zip(padSize, occupancy):
+            x.append(pad * padScale)
+            if occ is not None:
+                y.append(occ)
             else:
                 y.append(0)
                 print("There was a not defined occupancy, using the value 0 to avoid a crash")
-            graph = TGraph(bins, x, y)
-
-        return graph
-
-    def squarePadIntegrateGraph(self, bins, minPad, maxPad, padScale = 1, doLog = False):
-        from ROOT import TGraph  # type: ignore
-        from array import array
 
-        (padSize, occupancy) = self.squarePadIntegrateScan(bins, minPad, maxPad, doLog = doLog)
-        padSize = [pad*padScale for pad in padSize]
+        return TGraph(len(x), x, y)
 
-        x, y = array( 'd' ), array( 'd' )
-        graph = TGraph()
-        for ibin in range(len(padSize)):
-            x.append(padSize[ibin])
-            if occupancy[ibin] is not None:
-                y.append(occupancy[ibin])
-            else:
-                y.append(0)
-                print("There was a not defined occupancy, using the value 0 to avoid a crash")
-            graph = TGraph(bins, x, y)
+    def squarePadPeakUniformGraph(self, bins, minPad, maxPad, padScale = 1, doLog = False, level = 0, refine = None):
+        (padSize, occupancy) = self.squarePadPeakUniformScan(bins, minPad, maxPad, doLog = doLog, level = level, refine = refine)
+        return self._scanGraph(padSize, occupancy, padScale)
 
-        return graph
+    def squarePadIntegrateGraph(self, bins, minPad, maxPad, padScale = 1, doLog = False, level = 0, refine = None):
+        (padSize, occupancy) = self.squarePadIntegrateScan(bins, minPad, maxPad, doLog = doLog, level = level, refine = refine)
+        return self._scanGraph(padSize, occupancy, padScale)
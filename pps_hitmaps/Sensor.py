@@ -3,11 +3,273 @@ from __future__ import annotations
 from .ClassFields import *
 from .PPSHitmap import PPSHitmap
 from .SensorPad import SensorPad
+from .SensorPad import _binRanges, _windowFluxMap, _epochWeights
+
+def batchFlux(hitmap:PPSHitmap, bounds, shifts):
+    """
+    bounds - (pads, 4) array with the minX, maxX, minY and maxY of every pad in mm
+    shifts - (epochs, 2) array with the x and y shift of every epoch in mm
+    Returns a dict of (pads, epochs) arrays: totalFlux, maxFlux and minFlux (NaN when the pad sees no bin), occupancy
+    and the start/stop indices of the hitmap bins touched by every pad in every epoch
+    """
+    import numpy as np
+
+    hitmap._checkMap()
+
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    shifts = np.asarray(shifts, dtype=np.float64).reshape(-1, 2)
+
+    minX = bounds[:, 0, None] + shifts[None, :, 0]
+    maxX = bounds[:, 1, None] + shifts[None, :, 0]
+    minY = bounds[:, 2, None] + shifts[None, :, 1]
+    maxY = bounds[:, 3, None] + shifts[None, :, 1]
+
+    xStart, xStop = _binRanges(hitmap.xAxis, hitmap.xStep, minX, maxX)
+    yStart, yStop = _binRanges(hitmap.yAxis, hitmap.yStep, minY, maxY)
+
+    totalFlux = hitmap.integrateRect(minX/1000, maxX/1000, minY/1000, maxY/1000) # Remember PPSHitmap is in m, sensor is in mm
+    occupancyNorm = (hitmap.xStep *
+                     hitmap.yStep * 1.0E4) # in cm^2
+
+    return {
+        'totalFlux': totalFlux,
+        'maxFlux': hitmap._rangeReduce(xStart, xStop, yStart, yStop, "max"),
+        'minFlux': hitmap._rangeReduce(xStart, xStop, yStart, yStop, "min"),
+        'occupancyNorm': occupancyNorm,
+        'occupancy': totalFlux * 1.6E-12 * occupancyNorm,
+        'centerX': (minX + maxX)/2,
+        'centerY': (minY + maxY)/2,
+        'xStart': xStart,
+        'xStop': xStop,
+        'yStart': yStart,
+        'yStop': yStop,
+        }
+
+def _batchRows(batch, rows):
+    """The pads in rows of a batchFlux result"""
+    return {key: value if key == 'occupancyNorm' else value[rows] for key, value in batch.items()}
+
+def _roiMask(batch, bounds, binArea, roi, weights=None):
+    """
+    Pads of a batchFlux result that can hold the extreme value of the requested quantities, from bounds on the
+    fluence of their footprints, missing hitmap entries are not accounted for
+    roi - "dose" (maximum EOL dose), "voltage" (maximum and minimum EOL dose, which set the voltage window),
+          "occupancy" (maximum occupancy of each epoch) or a list of them
+    binArea - hitmap bin area in mm^2
+    weights - flux weight of every epoch, for partially completed schedules
+    """
+    import numpy as np
+
+    roiList = [roi] if isinstance(roi, str) else list(roi)
+    numPads, numEpochs = batch['totalFlux'].shape
+    weights = np.ones(numEpochs) if weights is None else np.asarray(weights, dtype=np.float64)
+
+    mask = np.zeros(numPads, dtype=bool)
+    if numPads == 0:
+        return mask
+
+    # The mean fluence over the pad is between its lowest and highest cell
+    padBins = (bounds[:, 1] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 2])/binArea
+    meanFlux = (batch['totalFlux'] * weights).sum(axis=1)/padBins
+    slack = 1e-9 # Rounding of the integrals
+
+    for quantity in roiList:
+        if quantity == "occupancy":
+            occupancy = batch['occupancy']
+            mask |= (occupancy >= occupancy.max(axis=0)).any(axis=1)
+        elif quantity in ("dose", "voltage"):
+            # A cell gets at most the highest bin of every footprint
+            maxBound = (np.nan_to_num(batch['maxFlux']) * weights).sum(axis=1)
+            mask |= maxBound >= meanFlux.max() * (1 - slack)
+            if quantity == "voltage":
+                # A cell is covered by at least one footprint, so it gets at least the lowest bin of one of them
+                started = weights > 0
+                minBound = (np.nan_to_num(batch['minFlux'][:, started]) * weights[started]).min(axis=1) if started.any() else np.zeros(numPads)
+                mask |= minBound <= meanFlux.min() * (1 + slack)
+        else:
+            raise ValueError("Unknown region of interest {}".format(quantity))
+
+    return mask
+
+def _dosesFromBatch(hitmap:PPSHitmap, batch, row):
+    """Unpacks one pad of a batchFlux result into the per epoch dose dicts of SensorPad"""
+    doses = []
+    for epoch in range(batch['totalFlux'].shape[1]):
+        maxFlux = float(batch['maxFlux'][row, epoch])
+        doses += [{
+            'totalFlux': float(batch['totalFlux'][row, epoch]),
+            'maxFlux': maxFlux if maxFlux == maxFlux else None,
+            'occupancyNorm': batch['occupancyNorm'],
+            'occupancy': float(batch['occupancy'][row, epoch]),
+            'fluxMap': _windowFluxMap(hitmap,
+                                      batch['xStart'][row, epoch], batch['xStop'][row, epoch],
+                                      batch['yStart'][row, epoch], batch['yStop'][row, epoch],
+                                      float(batch['centerX'][row, epoch]), float(batch['centerY'][row, epoch])),
+            }]
+    return doses
+
+_workerTask = None # (pads, method, kwargs) of the worker processes of _mapPads
+
+def _initPadWorker(pads, method, kwargs):
+    global _workerTask
+    _workerTask = (pads, method, kwargs)
+
+def _padWorker(start, stop):
+    pads, method, kwargs = _workerTask
+    return [getattr(pad, method)(**kwargs) for pad in pads[start:stop]]
+
+def _workerCount(nWorkers):
+    """nWorkers limited to the CPUs this process can use, more processes only add overhead"""
+    import os
+
+    if nWorkers is None:
+        return 1
+    try:
+        available = len(os.sched_getaffinity(0))
+    except AttributeError:
+        available = os.cpu_count() or 1
+    return max(1, min(nWorkers, available))
+
+def _mapPads(pads, method, nWorkers=None, **kwargs):
+    """
+    Calls method(**kwargs) of every pad, spread over nWorkers processes if more than one (at most one per CPU)
+    Returns the results in the order of pads. The pads are handed to every worker once when it starts, which
+    costs nothing with the fork start method, otherwise the pads and the arguments must be picklable
+    """
+    nWorkers = _workerCount(nWorkers)
+    if nWorkers <= 1 or len(pads) <= 1:
+        return [getattr(pad, method)(**kwargs) for pad in pads]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Only the index ranges of the pads travel with the tasks
+    numChunks = min(len(pads), 4*nWorkers)
+    bounds = [len(pads)*chunk//numChunks for chunk in range(numChunks + 1)]
+    with ProcessPoolExecutor(nWorkers, initializer=_initPadWorker, initargs=(pads, method, kwargs)) as pool:
+        results = pool.map(_padWorker, bounds[:-1], bounds[1:])
+        return [result for chunk in results for result in chunk]
+
+def _extendedAxis(axis, step, low, high):
+    """
+    Bin centres of axis (in m) extended with bins of size step (in m) to cover [low, high] (in mm)
+    Returns (extended axis, index of the first bin of axis in it)
+    """
+    import numpy as np
+    from math import ceil, floor
+
+    first = min(0, floor((low/1000 - axis[0])/step))
+    last = max(len(axis), ceil((high/1000 - axis[0])/step) + 1)
+
+    extended = axis[0] + np.arange(first, last)*step
+    extended[-first:-first+len(axis)] = axis
+    return extended, -first
+
+def _shiftLattice(hitmap:PPSHitmap, bounds, xRange, yRange):
+    """
+    Hitmap bins seen by the pads for shifts in steps of the hitmap bins
+    bounds - (pads, 4) array of pad bounds in mm, xRange and yRange the (min, max) shifts in mm
+    Returns (fluence, mask, xShifts, yShifts): with the shift (xShifts[dx], yShifts[dy]) the pads see
+    fluence[dx:dx+nx, dy:dy+ny][mask], mask being the (nx, ny) bins touching a pad at the lowest shift
+    """
+    import numpy as np
+
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    xShifts = xRange[0] + np.arange(int(np.floor((xRange[1] - xRange[0])/(hitmap.xStep*1000) + 1e-9)) + 1)*hitmap.xStep*1000
+    yShifts = yRange[0] + np.arange(int(np.floor((yRange[1] - yRange[0])/(hitmap.yStep*1000) + 1e-9)) + 1)*hitmap.yStep*1000
+
+    xAxis, xOffset = _extendedAxis(hitmap.xAxis, hitmap.xStep, bounds[:, 0].min() + xShifts[0] - 2*hitmap.xStep*1000, bounds[:, 1].max() + xShifts[-1] + 2*hitmap.xStep*1000)
+    yAxis, yOffset = _extendedAxis(hitmap.yAxis, hitmap.yStep, bounds[:, 2].min() + yShifts[0] - 2*hitmap.yStep*1000, bounds[:, 3].max() + yShifts[-1] + 2*hitmap.yStep*1000)
+
+    xStart, xStop = _binRanges(xAxis, hitmap.xStep, bounds[:, 0] + xShifts[0], bounds[:, 1] + xShifts[0])
+    yStart, yStop = _binRanges(yAxis, hitmap.yStep, bounds[:, 2] + yShifts[0], bounds[:, 3] + yShifts[0])
+    iLo, iHi = int(xStart.min()), int(xStop.max())
+    jLo, jHi = int(yStart.min()), int(yStop.max())
+
+    mask = np.zeros((max(iHi - iLo, 0), max(jHi - jLo, 0)), dtype=bool)
+    for x0, x1, y0, y1 in zip(xStart - iLo, xStop - iLo, yStart - jLo, yStop - jLo):
+        mask[x0:x1, y0:y1] = True
+
+    # Missing entries count as no flux, as in the dose rasters
+    fluence = np.zeros((iHi - iLo + len(xShifts) - 1, jHi - jLo + len(yShifts) - 1))
+    gridX = np.arange(hitmap.grid.shape[0]) + xOffset - iLo
+    gridY = np.arange(hitmap.grid.shape[1]) + yOffset - jLo
+    xIn = (gridX >= 0) & (gridX < fluence.shape[0])
+    yIn = (gridY >= 0) & (gridY < fluence.shape[1])
+    fluence[np.ix_(gridX[xIn], gridY[yIn])] = np.nan_to_num(hitmap.grid[np.ix_(xIn, yIn)])
+
+    return fluence, mask, xShifts, yShifts
+
+def _descendShifts(fluence, mask, positions, target=None, maxSweeps=20):
+    """
+    Moves one shift at a time to the (dx, dy) position minimising the peak of the summed fluence over the mask,
+    until no move improves it or the peak drops to target. Two shifts never share a position, duplicated starting
+    positions are moved to the closest free one first
+    Returns (positions, peak of the summed fluence)
+    """
+    import numpy as np
+
+    nx, ny = mask.shape
+    numX = fluence.shape[0] - nx + 1
+    numY = fluence.shape[1] - ny + 1
+
+    def window(position):
+        return fluence[position[0]:position[0]+nx, position[1]:position[1]+ny][mask]
+
+    positions = list(positions)
+    if len(positions) > numX*numY:
+        raise ValueError("Can not place {} shifts on {} distinct positions".format(len(positions), numX*numY))
+    used = set()
+    for k, position in enumerate(positions):
+        if position in used:
+            free = [(dx, dy) for dx in range(numX) for dy in range(numY) if (dx, dy) not in used]
+            positions[k] = min(free, key=lambda other: (other[0] - position[0])**2 + (other[1] - position[1])**2)
+        used.add(positions[k])
+
+    total = np.zeros(np.count_nonzero(mask))
+    for position in positions:
+        total += window(position)
+    peak = total.max() if len(total) != 0 else 0.
+
+    for sweep in range(maxSweeps):
+        improved = False
+        for k in range(len(positions)):
+            if target is not None and peak <= target:
+                return positions, peak
+
+            # The sum without shift k is updated incrementally, only its window changes
+            others = total - window(positions[k])
+            used.remove(positions[k])
+            for dx in range(numX):
+                for dy in range(numY):
+                    if (dx, dy) in used:
+                        continue
+                    candidate = (others + window((dx, dy))).max()
+                    if candidate < peak:
+                        peak = candidate
+                        positions[k] = (dx, dy)
+                        improved = True
+            total = others + window(positions[k])
+            used.add(positions[k])
+        if not improved:
+            break
+
+    return positions, peak
 
 def calcLossProb(deadtime, occupancy, bunchSpacing=25.):
-    from math import exp, floor
-    timeStep = floor(deadtime/float(bunchSpacing))
-    return 1 - (occupancy ** 2)/((1 - exp(-occupancy))**2) * exp(-2*occupancy * (timeStep + 1))
+    """
+    deadtime and bunchSpacing in ns, deadtime and occupancy can be arrays that broadcast against each other
+    Returns a float for scalar inputs, an array otherwise
+    """
+    import numpy as np
+
+    timeStep = np.floor(np.asarray(deadtime, dtype=np.float64)/float(bunchSpacing))
+    occupancy = np.asarray(occupancy, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        norm = (occupancy ** 2)/((1 - np.exp(-occupancy))**2)
+    norm = np.where(occupancy == 0, 1., norm) # The limit for no occupancy, where nothing is lost
+    lossProb = 1 - norm * np.exp(-2*occupancy * (timeStep + 1))
+
+    return float(lossProb) if lossProb.ndim == 0 else lossProb
 
 class Sensor:
     numPads = NonNegativeIntField()
@@ -29,6 +291,7 @@ class Sensor:
         self.maxY = 0
 
         self.hasFlux = False
+        self._padIndex = {} # Cell tables of locatePads, by useExtra
 
     def setShifts(self, shifts:list):
         self.shifts = shifts
@@ -37,27 +300,155 @@ class Sensor:
 
         self.hasFlux = False
 
-    def calculateFlux(self, hitmap:PPSHitmap):
+    def calculateFlux(self, hitmap:PPSHitmap, roi=None):
+        """
+        roi - only calculate the pads that can set "dose" (the maximum EOL dose), "voltage" (the EOL voltage window)
+              or "occupancy" (the maximum occupancy of each epoch), or a list of them. None calculates all the pads,
+              the original code only calculated the pads below 64 and above 239 of the standard layout
+        """
         if not isinstance(hitmap, PPSHitmap):
             raise ValueError(f'expecting PPSHitmap to calculate the dose')
 
         hitmap._checkMap()
 
-        for i in range(len(self.padVec)):
-            if i<64 or i>239:
-                self.padVec[i].calculateFlux(self.shifts, hitmap) # Remember PPSHitmap is in m, sensor is in mm
+        # One batch of all the pads gives both the region of interest and the doses
+        batches = self._padBatches(hitmap)
+        padIdx = self._roiPads(hitmap, roi, batches)
+        self._clearFlux(padIdx)
+        self._batchFlux(hitmap, padIdx, batches)
 
         self.hasFlux = True
-        
-    def calculatepartialFlux(self, integratedLuminosity, hitmap:PPSHitmap):
+
+    def _padBatches(self, hitmap:PPSHitmap):
+        """batchFlux of all the pads for all the epochs, without and with the interpad distance"""
+        for pad in self.padVec:
+            if pad.epochs != len(self.shifts):
+                raise ValueError(f'Expected the number of shift positions to match the number of epochs')
+
+        return batchFlux(hitmap, self.padBounds(), self.shifts), batchFlux(hitmap, self.padBounds(useExtra=True), self.shifts)
+
+    def _roiPads(self, hitmap:PPSHitmap, roi, batches, integratedLuminosity=None):
+        """
+        Indices of the pads in the region of interest roi (see calculateFlux), all the pads if roi is None
+        batches - the _padBatches of the pads
+        integratedLuminosity - in fb-1, only weigh the epochs started then, as calculatepartialFlux does
+        """
+        import numpy as np
+
+        if roi is None:
+            return list(range(len(self.padVec)))
+
+        binArea = hitmap.xStep * hitmap.yStep * 1e6 # in mm^2
+        mask = np.zeros(len(self.padVec), dtype=bool)
+        for batch, useExtra in zip(batches, (False, True)):
+            weights = None
+            if integratedLuminosity is not None:
+                weights = _epochWeights(len(self.shifts), integratedLuminosity, usePadSpacing=not useExtra)
+            mask |= _roiMask(batch, self.padBounds(useExtra=useExtra), binArea, roi, weights=weights)
+        return [int(i) for i in np.nonzero(mask)[0]]
+
+    def _clearFlux(self, keepIdx):
+        """Drops the doses of the pads not in keepIdx, so no stale results are mixed with new ones"""
+        keep = set(keepIdx)
+        for i, pad in enumerate(self.padVec):
+            if i not in keep:
+                pad.doses = []
+                pad.doses_extra = []
+                pad._epochCache = None
+
+    def _fluxPads(self):
+        """Indices of the pads whose flux has been calculated"""
+        return [i for i, pad in enumerate(self.padVec) if len(pad.doses) != 0]
+
+    def locatePads(self, x, y, useExtra=False):
+        """
+        x and y - arrays (or numbers) of points in mm, broadcast against each other
+        Returns the index in padVec of the pad strictly containing every point, -1 if there is none. Where pads
+        overlap the first one wins. useExtra includes the interpad distance in the pads
+        """
+        import numpy as np
+
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        shape = x.shape
+        x = x.ravel()
+        y = y.ravel()
+        bounds = self.padBounds(useExtra=useExtra)
+        edgesX, edgesY, table = self._cellTable(bounds, useExtra)
+
+        # The cell holding every point, a point on a cell edge is solved directly from the pads
+        xIdx = np.searchsorted(edgesX, x, side='right') - 1
+        yIdx = np.searchsorted(edgesY, y, side='right') - 1
+        inside = (xIdx >= 0) & (xIdx < len(edgesX) - 1) & (yIdx >= 0) & (yIdx < len(edgesY) - 1)
+        onEdge = inside & ((edgesX[np.clip(xIdx, 0, len(edgesX) - 1)] == x) | (edgesY[np.clip(yIdx, 0, len(edgesY) - 1)] == y))
+
+        padIdx = np.full(x.shape, -1, dtype=np.int64)
+        cells = inside & ~onEdge
+        padIdx[cells] = table[xIdx[cells], yIdx[cells]]
+
+        for point in np.nonzero(onEdge)[0]:
+            contains = ((bounds[:, 0] < x[point]) & (bounds[:, 1] > x[point]) &
+                        (bounds[:, 2] < y[point]) & (bounds[:, 3] > y[point]))
+            if contains.any():
+                padIdx[point] = contains.argmax()
+
+        return padIdx.reshape(shape) if len(shape) != 0 else int(padIdx[0])
+
+    def _cellTable(self, bounds, useExtra):
+        """
+        Cells between the sorted pad edges and the first pad covering each of them (-1 for none), rebuilt only
+        when the pad geometry changes
+        """
+        import numpy as np
+
+        key = bounds.tobytes()
+        if useExtra in self._padIndex and self._padIndex[useExtra][0] == key:
+            return self._padIndex[useExtra][1:]
+
+        edgesX = np.unique(bounds[:, :2])
+        edgesY = np.unique(bounds[:, 2:])
+        table = np.full((max(len(edgesX) - 1, 0), max(len(edgesY) - 1, 0)), -1, dtype=np.int64)
+
+        xStart = np.searchsorted(edgesX, bounds[:, 0])
+        xStop = np.searchsorted(edgesX, bounds[:, 1])
+        yStart = np.searchsorted(edgesY, bounds[:, 2])
+        yStop = np.searchsorted(edgesY, bounds[:, 3])
+        for idx in range(len(bounds) - 1, -1, -1): # Backwards, so the first pad wins
+            table[xStart[idx]:xStop[idx], yStart[idx]:yStop[idx]] = idx
+
+        self._padIndex[useExtra] = (key, edgesX, edgesY, table)
+        return edgesX, edgesY, table
+
+    def padBounds(self, useExtra=False):
+        """Returns a (pads, 4) array with the minX, maxX, minY and maxY of every pad in mm"""
+        import numpy as np
+
+        if useExtra:
+            return np.array([[pad.minX_extra, pad.maxX_extra, pad.minY_extra, pad.maxY_extra] for pad in self.padVec], dtype=np.float64).reshape(-1, 4)
+        return np.array([[pad.minX, pad.maxX, pad.minY, pad.maxY] for pad in self.padVec], dtype=np.float64).reshape(-1, 4)
+
+    def _batchFlux(self, hitmap:PPSHitmap, padIdx, batches):
+        """Fills the doses of the pads in padIdx for all epochs from their _padBatches"""
+        doses, doses_extra = batches
+        for i in padIdx:
+            self.padVec[i].doses = _dosesFromBatch(hitmap, doses, i)
+            self.padVec[i].doses_extra = _dosesFromBatch(hitmap, doses_extra, i)
+            self.padVec[i]._setEpochCache(self.shifts, hitmap, self.padVec[i].doses, self.padVec[i].doses_extra)
+
+    def calculatepartialFlux(self, integratedLuminosity, hitmap:PPSHitmap, roi=None):
+        """roi - see calculateFlux, evaluated for the epochs completed at integratedLuminosity"""
         if not isinstance(hitmap, PPSHitmap):
             raise ValueError(f'expecting PPSHitmap to calculate the dose')
 
         hitmap._checkMap()
 
-        for i in range(len(self.padVec)):
-            if i<64 or i>239:
-                self.padVec[i].calculatepartialFlux(self.shifts, integratedLuminosity, hitmap) # Remember PPSHitmap is in m, sensor is in mm
+        batches = self._padBatches(hitmap)
+        padIdx = self._roiPads(hitmap, roi, batches, integratedLuminosity=integratedLuminosity)
+        self._clearFlux(padIdx)
+        for i in padIdx:
+            # The doses of the full epochs come from the same batch, unless the pad already has them
+            if not self.padVec[i]._hasEpochCache(self.shifts, hitmap):
+                self.padVec[i]._setEpochCache(self.shifts, hitmap, _dosesFromBatch(hitmap, batches[0], i), _dosesFromBatch(hitmap, batches[1], i))
+            self.padVec[i].calculatepartialFlux(self.shifts, integratedLuminosity, hitmap) # Remember PPSHitmap is in m, sensor is in mm
 
         self.hasFlux = True
 
@@ -65,30 +456,66 @@ class Sensor:
         if not self.hasFlux:
             raise RuntimeError("You must calculate the fluxes before retrieving the max occupancy")
 
-        occupancy = []
+        occupancy = self.occupancyMatrix(usePadSpacing=usePadSpacing)
+        padIdx = self.maxOccupancyPads(usePadSpacing=usePadSpacing)
+
+        return [float(occupancy[padIdx[epoch], epoch]) for epoch in range(len(self.shifts))]
+
+    def occupancyMatrix(self, usePadSpacing=True):
+        """(pads, epochs) array of the occupancy of every pad in each epoch, NaN for the pads without calculated flux"""
+        import numpy as np
+
+        occupancy = np.full((len(self.padVec), len(self.shifts)), np.nan)
+        for idx in self._fluxPads():
+            doses = self.padVec[idx].doses if usePadSpacing else self.padVec[idx].doses_extra
+            occupancy[idx] = [dose["occupancy"] for dose in doses]
+        return occupancy
+
+    def maxOccupancyPads(self, usePadSpacing=True):
+        """Index of the pad with the highest occupancy in each epoch, the first one on ties"""
+        import numpy as np
+
+        occupancy = self.occupancyMatrix(usePadSpacing=usePadSpacing)
         for epoch in range(len(self.shifts)):
-            padIdx = None
-
-            for idx in range(len(self.padVec)):
-                if padIdx is None:
-                    padIdx = idx
-                else:
-                    if usePadSpacing:
-                        if self.padVec[idx].doses[epoch]["occupancy"] > self.padVec[padIdx].doses[epoch]["occupancy"]:
-                            padIdx = idx
-                    else:
-                        if self.padVec[idx].doses_extra[epoch]["occupancy"] > self.padVec[padIdx].doses_extra[epoch]["occupancy"]:
-                            padIdx = idx
-
-            if padIdx is None:
+            if np.isnan(occupancy[:, epoch]).all():
                 raise RuntimeError("Unable to find pad with max occupancy for epoch {}".format(epoch))
+        return np.nanargmax(occupancy, axis=0)
 
-            if usePadSpacing:
-                occupancy += [self.padVec[padIdx].doses[epoch]["occupancy"]]
-            else:
-                occupancy += [self.padVec[padIdx].doses_extra[epoch]["occupancy"]]
+    def topK(self, k, usePadSpacing=True, epoch=None):
+        """
+        The k pads with the highest occupancy, in epoch or, if None, their highest over all epochs
+        Returns (pad indices, occupancies), hottest first
+        """
+        import numpy as np
 
-        return occupancy
+        occupancy = self.occupancyMatrix(usePadSpacing=usePadSpacing)
+        occupancy = occupancy[:, epoch] if epoch is not None else np.max(occupancy, axis=1, initial=-np.inf, where=~np.isnan(occupancy))
+
+        padIdx = np.nonzero(~np.isnan(occupancy) & (occupancy != -np.inf))[0]
+        k = min(k, len(padIdx))
+        if k < len(padIdx):
+            padIdx = padIdx[np.argpartition(-occupancy[padIdx], k-1)[:k]]
+        padIdx = padIdx[np.lexsort((padIdx, -occupancy[padIdx]))] # Stable order on ties
+
+        return padIdx, occupancy[padIdx]
+
+    def occupancyPercentile(self, q, usePadSpacing=True):
+        """q-th percentile (0-100, or an array of them) of the pad occupancies in each epoch, over the pads with calculated flux"""
+        import numpy as np
+
+        return np.nanpercentile(self.occupancyMatrix(usePadSpacing=usePadSpacing), q, axis=0)
+
+    def lossProbability(self, deadtimes, usePadSpacing=True, bunchSpacing=25.):
+        """
+        deadtimes - array of dead times in ns
+        Returns the (pads, epochs, deadtimes) array of the event loss probability (calcLossProb) of every pad, NaN for
+        the pads without calculated flux
+        """
+        import numpy as np
+
+        occupancy = self.occupancyMatrix(usePadSpacing=usePadSpacing)
+        deadtimes = np.asarray(deadtimes, dtype=np.float64).reshape(-1)
+        return calcLossProb(deadtimes[None, None, :], occupancy[:, :, None], bunchSpacing=bunchSpacing)
 
     def plotOccupancy(self, usePadSpacing=True):
         if not self.hasFlux:
@@ -110,20 +537,11 @@ class Sensor:
 
         from ROOT import TCanvas, TH2D  # type: ignore
         from array import array
+        import numpy as np
 
-        edgesX = []
-        edgesY = []
-        for pad in self.padVec:
-            if pad.minX_extra not in edgesX:
-                edgesX += [pad.minX_extra]
-            if pad.maxX_extra not in edgesX:
-                edgesX += [pad.maxX_extra]
-            if pad.minY_extra not in edgesY:
-                edgesY += [pad.minY_extra]
-            if pad.maxY_extra not in edgesY:
-                edgesY += [pad.maxY_extra]
-        edgesX.sort()
-        edgesY.sort()
+        bounds = self.padBounds(useExtra=True)
+        edgesX = np.unique(bounds[:, :2]).tolist()
+        edgesY = np.unique(bounds[:, 2:]).tolist()
 
         xArr, yArr = array( 'd' ), array( 'd' )
         for edge in edgesX:
@@ -144,6 +562,14 @@ class Sensor:
         numBinsX = len(xArr)-1
         numBinsY = len(yArr)-1
 
+        # Pad of every bin, the bins with no pad (index -1) get the zero occupancy in the last row
+        binCentersX = (np.array(edgesX[:-1]) + np.array(edgesX[1:]))/2
+        binCentersY = (np.array(edgesY[:-1]) + np.array(edgesY[1:]))/2
+        binPads = self.locatePads(binCentersX[:, None], binCentersY[None, :], useExtra=True)
+
+        padOccupancy = np.zeros((len(self.padVec) + 1, len(self.shifts)))
+        padOccupancy[:-1] = np.nan_to_num(self.occupancyMatrix(usePadSpacing=usePadSpacing))
+
         for epoch in range(len(self.shifts)):
             pad = canv.cd(epoch+1)
             #pad.SetLogz()
@@ -157,27 +583,10 @@ class Sensor:
             hist.SetTitle("Occupancy Position {}".format(self.shifts[epoch]))
 
             for binX in range(numBinsX):
-                binXPos = (edgesX[binX] + edgesX[binX+1])/2
                 for binY in range(numBinsY):
-                    binYPos = (edgesY[binY] + edgesY[binY+1])/2
-
-                    occupancy = 0
-                    for pad in self.padVec:
-                        padMinX = pad.minX_extra
-                        padMaxX = pad.maxX_extra
-                        padMinY = pad.minY_extra
-                        padMaxY = pad.maxY_extra
-                        if ((binXPos > padMinX and binXPos < padMaxX) and
-                            (binYPos > padMinY and binYPos < padMaxY)):
-                            if usePadSpacing:
-                                occupancy = pad.doses[epoch]["occupancy"]
-                            else:
-                                occupancy = pad.doses_extra[epoch]["occupancy"]
-                            break
-
-                    binx = hist.GetXaxis().FindBin(binXPos)
-                    biny = hist.GetYaxis().FindBin(binYPos)
-                    hist.SetBinContent(binx, biny, occupancy)
+                    binx = hist.GetXaxis().FindBin(binCentersX[binX])
+                    biny = hist.GetYaxis().FindBin(binCentersY[binY])
+                    hist.SetBinContent(binx, biny, padOccupancy[binPads[binX, binY], epoch])
 
             hist.Draw("colz")
 
@@ -203,6 +612,7 @@ class Sensor:
 
         from ROOT import TCanvas, TH2D, TGraph  # type: ignore
         from array import array
+        import numpy as np
 
         persistance = {}
         canv = TCanvas("epoch_loss_probability", "Epoch Loss Probability", padX * 400, padY * 400)
@@ -227,11 +637,9 @@ class Sensor:
             persistance[self.shifts[epoch]]["frame"].SetTitle("Position {}".format(self.shifts[epoch]))
             persistance[self.shifts[epoch]]["frame"].Draw()
 
-            timeArr, lossProb = array( 'd' ), array( 'd' )
-            for i in range(timeSteps):
-                time = minTime + i * float(maxTime - minTime)/timeSteps
-                timeArr.append(time)
-                lossProb.append(calcLossProb(time, occupancy[epoch]))
+            times = minTime + np.arange(timeSteps) * float(maxTime - minTime)/timeSteps
+            timeArr = array( 'd', times.tolist() )
+            lossProb = array( 'd', calcLossProb(times, occupancy[epoch]).tolist() )
             persistance[self.shifts[epoch]]["graph"] = TGraph(timeSteps, timeArr, lossProb)
             persistance[self.shifts[epoch]]["graph"].Draw("l same")
 
@@ -285,11 +693,17 @@ class Sensor:
 
         return fig
 
-    def maxDoseEOL(self, integratedLuminosity=300, usePadSpacing = True):
+    def _padResults(self, padIdx, method, nWorkers=None, **kwargs):
+        """Calls method(**kwargs) of the pads in padIdx, see _mapPads"""
+        return _mapPads([self.padVec[i] for i in padIdx], method, nWorkers=nWorkers, **kwargs)
+
+    def maxDoseEOL(self, integratedLuminosity=300, usePadSpacing = True, nWorkers=None):
+        """nWorkers - number of worker processes the pads are split between, None to work in this process"""
         maxDose = None
 
-        for pad in self.padVec:
-            padDose = pad.maxDoseEOL(integratedLuminosity=integratedLuminosity, usePadSpacing=usePadSpacing)
+        padDoses = self._padResults(self._fluxPads(), "maxDoseEOL", nWorkers=nWorkers,
+                                    integratedLuminosity=integratedLuminosity, usePadSpacing=usePadSpacing)
+        for padDose in padDoses:
             if maxDose is None:
                 maxDose = padDose
             else:
@@ -298,17 +712,135 @@ class Sensor:
 
         return maxDose
     
-    def getVoltageEOL(self, chargeFunc, usePadSpacing=True, integratedLuminosity=300, numberofPads=16):
-        totalmin=0
-        totalmax=99999
-        for i in range(0,numberofPads):
-            minV, maxV = self.padVec[i].getVoltageEOL(chargeFunc, integratedLuminosity)
-            if minV>totalmin:
-                totalmin=minV
-            if maxV<totalmax:
-                totalmax=maxV
-        for i in range(240,256):
-            minV, maxV = self.padVec[i].getVoltageEOL(chargeFunc, integratedLuminosity)
-            if maxV<totalmax:
-                totalmax=maxV
-        return (totalmin,totalmax)
\ No newline at end of file
+    def optimizeShifts(self, hitmap:PPSHitmap, yRange, numShifts=None, x=None, xRange=None, integratedLuminosity=300, usePadSpacing=True, thresholdFlux=None, maxShifts=16, maxSweeps=20):
+        """
+        Searches the shifts minimising the peak end of life fluence of the pads, the maxDoseEOL of the schedule
+        yRange - (min, max) of the y shifts in mm
+        x - x shift in mm, defaults to the x of the current shifts
+        xRange - (min, max) of the x shifts in mm, to also search the x shifts
+        numShifts - number of shifts, if None the fewest shifts (up to maxShifts) keeping the peak at or below thresholdFlux
+        thresholdFlux in p/cm^2, as in PPSHitmap.plotShifts
+        The shifts move in steps of the hitmap bins, each candidate is evaluated incrementally on the summed hitmap,
+        two shifts never share a position
+        Only the peak is minimised, there is no minimum spacing between the shifts: when the fluence keeps falling
+        towards one edge of yRange several shifts can end up next to each other at that edge
+        Returns (shifts, peak fluence in p/cm^2), the sensor shifts are not changed
+        Raises a RuntimeError when numShifts is None and no schedule of up to maxShifts shifts reaches thresholdFlux
+        """
+        if not isinstance(hitmap, PPSHitmap):
+            raise ValueError(f'expecting PPSHitmap to optimize the shifts')
+        if numShifts is None and thresholdFlux is None:
+            raise ValueError("Either the number of shifts or the threshold flux must be given")
+
+        hitmap._checkMap()
+
+        if xRange is None:
+            if x is None:
+                if len(self.shifts) == 0:
+                    raise ValueError("No x shift given and the sensor has no shifts to take it from")
+                x = self.shifts[0][0]
+            xRange = (x, x)
+
+        fluence, mask, xShifts, yShifts = _shiftLattice(hitmap, self.padBounds(useExtra=not usePadSpacing), xRange, yRange)
+
+        # Every shift needs its own position on the lattice
+        shiftCounts = [numShifts] if numShifts is not None else range(1, min(maxShifts, len(xShifts)*len(yShifts))+1)
+        for count in shiftCounts:
+            # Start from evenly spaced shifts
+            if count > 1:
+                positions = [(len(xShifts)//2, round(k*(len(yShifts) - 1)/(count - 1))) for k in range(count)]
+            else:
+                positions = [(len(xShifts)//2, len(yShifts)//2)]
+
+            epochLumi = float(integratedLuminosity)/count
+            target = thresholdFlux/epochLumi if thresholdFlux is not None else None
+            positions, peak = _descendShifts(fluence, mask, positions, target=target, maxSweeps=maxSweeps)
+            if target is None or peak <= target:
+                break
+        else:
+            if numShifts is None:
+                raise RuntimeError("No schedule of up to {} shifts keeps the peak fluence at or below {}, the best one with {} shifts reaches {}".format(
+                                   count, thresholdFlux, count, float(peak) * epochLumi))
+
+        shifts = [(round(float(xShifts[dx]), 9), round(float(yShifts[dy]), 9)) for dx, dy in positions]
+        return (shifts, float(peak) * epochLumi)
+
+    def voltageWindowVsLuminosity(self, chargeFunc, luminosities=None, usePadSpacing=True, minCharge=10, maxCharge=100, maxVolt=700, numPoints=100,
+                                  solver="grid", integerVolts=True, cacheKey=None):
+        """
+        luminosities in fb-1, defaults to numPoints steps up to 300 fb-1
+        Returns (lumi, padMinVolt, padMaxVolt, overflowLumi):
+          padMinVolt and padMaxVolt - (pads, luminosities) arrays with the voltage window of every pad, NaN for pads
+                                without flux or without a working voltage
+          overflowLumi - interpolated luminosity where the window of the whole sensor closes, None if it stays open
+        """
+        if not self.hasFlux:
+            raise RuntimeError("You must calculate the fluxes before scanning the luminosity")
+
+        import numpy as np
+        from .ChargeSolver import windowClosingLuminosity
+
+        if luminosities is None:
+            luminosities = [300*i/numPoints for i in range(1, numPoints+1)]
+        lumi = np.asarray(luminosities, dtype=np.float64)
+
+        padMinVolt = np.full((len(self.padVec), len(lumi)), np.nan)
+        padMaxVolt = np.full((len(self.padVec), len(lumi)), np.nan)
+        computed = np.zeros(len(self.padVec), dtype=bool)
+        for i, pad in enumerate(self.padVec):
+            if pad._epochCache is None:
+                continue
+            _, padMinVolt[i], padMaxVolt[i] = pad.voltageWindowVsLuminosity(chargeFunc, lumi, usePadSpacing=usePadSpacing, minCharge=minCharge, maxCharge=maxCharge, maxVolt=maxVolt,
+                                                                            solver=solver, integerVolts=integerVolts, cacheKey=cacheKey)
+            computed[i] = True
+
+        if not computed.any():
+            raise RuntimeError("None of the pads has the doses of its epochs calculated")
+
+        # The sensor works while every pad works, a pad without a working voltage closes the window
+        sensorMinVolt = np.max(padMinVolt[computed], axis=0)
+        sensorMaxVolt = np.min(np.where(np.isnan(padMaxVolt[computed]), np.inf, padMaxVolt[computed]), axis=0)
+        sensorMaxVolt[np.isinf(sensorMaxVolt)] = np.nan
+        overflowLumi = windowClosingLuminosity(lumi, sensorMinVolt, sensorMaxVolt)
+
+        return lumi, padMinVolt, padMaxVolt, overflowLumi
+
+    def getVoltageEOL(self, chargeFunc, usePadSpacing=True, integratedLuminosity=300, numberofPads=None, solver="grid", integerVolts=True, nWorkers=None, cacheKey=None):
+        """
+        Voltage window of the pads whose flux was calculated, calculateFlux(hitmap, roi="voltage") only calculates
+        the pads that can set it
+        numberofPads - None uses all the pads whose flux was calculated. Otherwise the minimum voltage comes from the
+                       numberofPads pads with the highest maxDoseEOL and the maximum voltage from those and the
+                       numberofPads pads with the lowest one. The original code took the first numberofPads pads (16 by
+                       default) and the last 16 pads of the standard layout instead
+        nWorkers - number of worker processes the pads are split between, None to work in this process, see _mapPads
+        solver - see SensorPad.getVoltageEOL, "table" is the fastest but can be 1 or 2 V off the "grid" window
+        cacheKey - key of chargeFunc for the "table" solver, see SensorPad.getVoltageEOL
+        """
+        import numpy as np
+        from .ChargeSolver import padVoltageWindow
+
+        padIdx = self._fluxPads()
+        if len(padIdx) == 0:
+            raise RuntimeError("You must calculate the fluxes before retrieving the voltage window")
+
+        if numberofPads is not None and numberofPads < 1:
+            raise ValueError("numberofPads must be at least 1, got {}".format(numberofPads))
+
+        # The most irradiated pads set the minimum voltage, the least irradiated ones only the maximum
+        maxOnly = []
+        if numberofPads is not None and 2*numberofPads < len(padIdx):
+            padDoses = self._padResults(padIdx, "maxDoseEOL", nWorkers=nWorkers,
+                                        integratedLuminosity=integratedLuminosity, usePadSpacing=usePadSpacing)
+            order = [padIdx[i] for i in np.argsort(-np.array(padDoses), kind='stable')]
+            padIdx = order[:numberofPads]
+            maxOnly = order[-numberofPads:]
+
+        windows = self._padResults(padIdx + maxOnly, "getVoltageEOL", nWorkers=nWorkers,
+                                   chargeFunc=chargeFunc, integratedLuminosity=integratedLuminosity, usePadSpacing=usePadSpacing,
+                                   solver=solver, integerVolts=integerVolts, cacheKey=cacheKey)
+        padMinV = np.array([np.nan if minV is None else minV for minV, maxV in windows], dtype=np.float64)
+        padMaxV = np.array([np.nan if maxV is None else maxV for minV, maxV in windows], dtype=np.float64)
+        padMinV[len(padIdx):] = -np.inf
+
+        return padVoltageWindow(padMinV, padMaxV, integerVolts=integerVolts)
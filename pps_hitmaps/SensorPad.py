@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 from .ClassFields import *
+from .FluxMap import FluxMap
 
 def cleanEdges(edgeList, threshold=0.000001):
     newEdges = []
@@ -14,15 +15,106 @@ def cleanEdges(edgeList, threshold=0.000001):
 
     return newEdges
 
-def summariseEdges(edgeListVector, threshold=0.000001):
-    allEdges = []
-
-    for edgelist in edgeListVector:
-        allEdges += edgelist
-
-    allEdges.sort()
-
-    return cleanEdges(allEdges, threshold=threshold)
+def mergeEdges(edges, threshold=0.000001):
+    """Sorted edges, dropping every edge closer than threshold to the previous one"""
+    import numpy as np
+
+    edges = np.sort(np.asarray(edges, dtype=np.float64))
+    if len(edges) == 0:
+        return edges
+    return edges[np.concatenate(([True], np.diff(edges) > threshold))]
+
+def _binRange(axis, step, low, high):
+    """
+    axis holds the bin centres in m and step the bin size in m, low and high are in mm
+    Returns the start and stop indices of the bins touching [low, high]
+    """
+    from math import floor
+
+    # Start from an estimate and settle it with the same edge arithmetic used for the contributions
+    numBins = len(axis)
+    start = min(max(floor((low/1000 - axis[0])/step), 0), numBins)
+    while start > 0 and axis[start-1]*1000 + step*1000/2 >= low:
+        start -= 1
+    while start < numBins and axis[start]*1000 + step*1000/2 < low:
+        start += 1
+
+    stop = min(max(floor((high/1000 - axis[0])/step) + 1, start), numBins)
+    while stop < numBins and axis[stop]*1000 - step*1000/2 <= high:
+        stop += 1
+    while stop > start and axis[stop-1]*1000 - step*1000/2 > high:
+        stop -= 1
+
+    return start, stop
+
+def _binRanges(axis, step, low, high):
+    """Same as _binRange, for arrays of bounds"""
+    import numpy as np
+
+    start = np.searchsorted(axis*1000 + step*1000/2, low, side='left')
+    stop = np.searchsorted(axis*1000 - step*1000/2, high, side='right')
+    return start, np.maximum(stop, start)
+
+def _windowFluxMap(hitmap, xStart, xStop, yStart, yStop, centerPadX, centerPadY):
+    """The flux of every bin in the window, with the bin geometry relative to the pad centre in mm"""
+    xStart, xStop, yStart, yStop = int(xStart), int(xStop), int(yStart), int(yStop)
+    return FluxMap(hitmap.grid[xStart:xStop, yStart:yStop], # A view, the grid is not copied
+                   hitmap.xAxis[xStart:xStop]*1000,
+                   hitmap.yAxis[yStart:yStop]*1000,
+                   hitmap.xStep*1000,
+                   hitmap.yStep*1000,
+                   centerPadX,
+                   centerPadY)
+
+def _cellBins(lowEdges, highEdges, centers):
+    """Index of the bin holding every centre, and whether the centre is strictly inside it"""
+    import numpy as np
+
+    idx = np.searchsorted(lowEdges, centers, side='left') - 1
+    inside = idx >= 0
+    idx = np.clip(idx, 0, max(len(lowEdges) - 1, 0))
+    if len(lowEdges) != 0:
+        inside &= (centers > lowEdges[idx]) & (centers < highEdges[idx])
+    return idx, inside
+
+def _partialEpochs(numShifts, integratedLuminosity):
+    """
+    Number of epochs started at integratedLuminosity (in fb-1, out of 300) and the completed fraction of the last one
+    """
+    relevantShifts = float(numShifts)*float(integratedLuminosity)/300.0
+    intpart,floatpart = divmod(relevantShifts,1)
+    isfractionary = floatpart>0.0001
+    if isfractionary:
+        return min(int(intpart)+1, numShifts), floatpart
+    return min(int(intpart), numShifts), 1
+
+def _epochWeights(numShifts, integratedLuminosity, usePadSpacing=True):
+    """
+    Flux weight of every epoch at integratedLuminosity (in fb-1, out of 300): 1 for the completed epochs, the
+    completed fraction for the last started one and 0 for the others
+    With the interpad distance (usePadSpacing False) the last started epoch is counted in full
+    """
+    import numpy as np
+
+    numEpochs, fraction = _partialEpochs(numShifts, integratedLuminosity)
+    weights = np.zeros(numShifts)
+    weights[:numEpochs] = 1
+    if numEpochs > 0 and usePadSpacing:
+        weights[numEpochs-1] = fraction
+    return weights
+
+def _scaledDose(dose, fraction):
+    """Copy of an epoch dose with the flux scaled by fraction, the maximum flux is left as is"""
+    if fraction == 1:
+        return dict(dose)
+
+    return {
+        'totalFlux': dose['totalFlux'] * fraction,
+        'maxFlux': dose['maxFlux'],
+        'occupancyNorm': dose['occupancyNorm'],
+        'occupancy': dose['totalFlux'] * fraction * 1.6E-12 * dose['occupancyNorm'],
+        'fluxMap': dose['fluxMap'].scaled(fraction),
+        }
 
 # Pad dimensions in mm
 # Assume a default pad size of 1.3 mm
@@ -64,6 +156,13 @@ class SensorPad:
 
         self.doses = []
         self.doses_extra = []
+        self._epochCache = None
+
+    def __getstate__(self):
+        # The epoch cache refers to the hitmap, do not copy it along with the pad (e.g. to worker processes)
+        state = self.__dict__.copy()
+        state['_epochCache'] = None
+        return state
 
     def setEpochs(self, epochs:int):
         self.epochs = epochs
@@ -72,324 +171,137 @@ class SensorPad:
         if len(shifts) != self.epochs:
             raise ValueError(f'Expected the number of shift positions to match the number of epochs')
 
-        self.doses = []
-        self.doses_extra = []
-
-        for epoch in range(self.epochs):
-            minX = self.minX + shifts[epoch][0]
-            maxX = self.maxX + shifts[epoch][0]
-            minY = self.minY + shifts[epoch][1]
-            maxY = self.maxY + shifts[epoch][1]
-
-            centerPadX = (minX + maxX)/2
-            centerPadY = (minY + maxY)/2
-
-            minX_extra = self.minX_extra + shifts[epoch][0]
-            maxX_extra = self.maxX_extra + shifts[epoch][0]
-            minY_extra = self.minY_extra + shifts[epoch][1]
-            maxY_extra = self.maxY_extra + shifts[epoch][1]
-
-            centerPadX_extra = (minX_extra + maxX_extra)/2
-            centerPadY_extra = (minY_extra + maxY_extra)/2
-
-            flux = 0
-            flux_extra = 0
-            maxFlux = None
-            maxFlux_extra = None
-            fluxMap = []
-            fluxMap_extra = []
-
-            for x in hitmap.map:
-                xVal = x*1000
-                left = xVal - hitmap.xStep*1000/2
-                right = xVal + hitmap.xStep*1000/2
-
-                inSensitiveArea = True
-                inSensitiveArea_extra = True
-
-                if ((left < minX and right < minX) or
-                    (left > maxX and right > maxX)):
-                    inSensitiveArea = False
-
-                if ((left < minX_extra and right < minX_extra) or
-                    (left > maxX_extra and right > maxX_extra)):
-                    inSensitiveArea_extra = False
-
-                contributionX = 0
-                if inSensitiveArea:
-                    contributionX = 1
-                    if right > maxX:
-                        contributionX -= (right - maxX)/(hitmap.xStep*1000)
-                    if left < minX:
-                        contributionX -= (minX - left)/(hitmap.xStep*1000)
-
-                contributionX_extra = 0
-                if inSensitiveArea_extra:
-                    contributionX_extra = 1
-                    if right > maxX_extra:
-                        contributionX_extra -= (right - maxX_extra)/(hitmap.xStep*1000)
-                    if left < minX_extra:
-                        contributionX_extra -= (minX_extra - left)/(hitmap.xStep*1000)
-
-                if not (inSensitiveArea or inSensitiveArea_extra):
-                    continue
+        epochDoses, epochDoses_extra = self._epochDoses(shifts, hitmap)
+        self.doses = [dict(dose) for dose in epochDoses]
+        self.doses_extra = [dict(dose) for dose in epochDoses_extra]
 
-                for y in hitmap.map[x]:
-                    yVal = y*1000
-                    bottom = yVal - hitmap.yStep*1000/2
-                    top = yVal + hitmap.yStep*1000/2
-
-                    inSensitiveAreaY = True
-                    inSensitiveAreaY_extra = True
-
-                    if ((bottom < minY and top < minY) or
-                        (bottom > maxY and top > maxY)):
-                        inSensitiveAreaY = False
-
-                    if ((bottom < minY_extra and top < minY_extra) or
-                        (bottom > maxY_extra and top > maxY_extra)):
-                        inSensitiveAreaY_extra = False
-
-                    if inSensitiveArea and inSensitiveAreaY:
-                        contributionY = 1
-                        if top > maxY:
-                            contributionY -= (top - maxY)/(hitmap.yStep*1000)
-                        if bottom < minY:
-                            contributionY -= (minY - bottom)/(hitmap.yStep*1000)
-
-                        flux += hitmap.map[x][y] * contributionX * contributionY
-
-                        if maxFlux is None or hitmap.map[x][y] > maxFlux:
-                            maxFlux = hitmap.map[x][y]
-
-                        fluxMap += [{
-                            'flux': hitmap.map[x][y],
-                            'x': xVal,
-                            'y': yVal,
-                            'xLocal': xVal - centerPadX,
-                            'yLocal': yVal - centerPadY,
-                            'leftLocal': left - centerPadX,
-                            'rightLocal': right - centerPadX,
-                            'topLocal': top - centerPadY,
-                            'bottomLocal': bottom - centerPadY,
-                        }]
-
-                    if inSensitiveArea_extra and inSensitiveAreaY_extra:
-                        contributionY_extra = 1
-                        if top > maxY_extra:
-                            contributionY_extra -= (top - maxY_extra)/(hitmap.yStep*1000)
-                        if bottom < minY_extra:
-                            contributionY_extra -= (minY_extra - bottom)/(hitmap.yStep*1000)
-
-                        flux_extra += hitmap.map[x][y] * contributionX_extra * contributionY_extra
-
-                        if maxFlux_extra is None or hitmap.map[x][y] > maxFlux_extra:
-                            maxFlux_extra = hitmap.map[x][y]
-
-                        fluxMap_extra += [{
-                            'flux': hitmap.map[x][y],
-                            'x': xVal,
-                            'y': yVal,
-                            'xLocal': xVal - centerPadX_extra,
-                            'yLocal': yVal - centerPadY_extra,
-                            'leftLocal': left - centerPadX_extra,
-                            'rightLocal': right - centerPadX_extra,
-                            'topLocal': top - centerPadY_extra,
-                            'bottomLocal': bottom - centerPadY_extra,
-                        }]
-
-            occupancyNorm = (hitmap.xStep *
-                             hitmap.yStep * 1.0E4) # in cm^2
-
-            self.doses += [{
-                'totalFlux': flux,
-                'maxFlux': maxFlux,
-                'occupancyNorm': occupancyNorm,
-                'occupancy': flux * 1.6E-12 * occupancyNorm,
-                'fluxMap': fluxMap,
-                }]
-            self.doses_extra += [{
-                'totalFlux': flux_extra,
-                'maxFlux': maxFlux_extra,
-                'occupancyNorm': occupancyNorm,
-                'occupancy': flux_extra * 1.6E-12 * occupancyNorm,
-                'fluxMap': fluxMap_extra,
-                }]
-            
     def calculatepartialFlux(self, shifts, integratedLuminosity, hitmap): # Remember PPSHitmap is in m, sensor is in mm
         #if len(shifts) != self.epochs:
         #    raise ValueError(f'Expected the number of shift positions to match the number of epochs')
-            
-        relevantShifts = float(len(shifts))*float(integratedLuminosity)/300.0 
-        intpart,floatpart = divmod(relevantShifts,1)
-        isfractionary = floatpart>0.0001
-        cutshifts = []
-        if isfractionary:
-            cutshifts = shifts[:int(intpart)+1]
-        else:
-            cutshifts = shifts[:int(intpart)]
-            floatpart = 1
+
+        # The doses of every full epoch are cached, only the last partial epoch is scaled
+        epochDoses, epochDoses_extra = self._epochDoses(shifts, hitmap)
+        numEpochs, _ = _partialEpochs(len(shifts), integratedLuminosity)
+        weights = _epochWeights(len(shifts), integratedLuminosity)
+        weights_extra = _epochWeights(len(shifts), integratedLuminosity, usePadSpacing=False)
 
         self.doses = []
         self.doses_extra = []
-
-        for epoch in range(len(cutshifts)):
-            minX = self.minX + shifts[epoch][0]
-            maxX = self.maxX + shifts[epoch][0]
-            minY = self.minY + shifts[epoch][1]
-            maxY = self.maxY + shifts[epoch][1]
-
-            centerPadX = (minX + maxX)/2
-            centerPadY = (minY + maxY)/2
-
-            minX_extra = self.minX_extra + shifts[epoch][0]
-            maxX_extra = self.maxX_extra + shifts[epoch][0]
-            minY_extra = self.minY_extra + shifts[epoch][1]
-            maxY_extra = self.maxY_extra + shifts[epoch][1]
-
-            centerPadX_extra = (minX_extra + maxX_extra)/2
-            centerPadY_extra = (minY_extra + maxY_extra)/2
-
-            flux = 0
-            flux_extra = 0
-            maxFlux = None
-            maxFlux_extra = None
-            fluxMap = []
-            fluxMap_extra = []
-
-            for x in hitmap.map:
-                xVal = x*1000
-                left = xVal - hitmap.xStep*1000/2
-                right = xVal + hitmap.xStep*1000/2
-
-                inSensitiveArea = True
-                inSensitiveArea_extra = True
-
-                if ((left < minX and right < minX) or
-                    (left > maxX and right > maxX)):
-                    inSensitiveArea = False
-
-                if ((left < minX_extra and right < minX_extra) or
-                    (left > maxX_extra and right > maxX_extra)):
-                    inSensitiveArea_extra = False
-
-                contributionX = 0
-                if inSensitiveArea:
-                    contributionX = 1
-                    if right > maxX:
-                        contributionX -= (right - maxX)/(hitmap.xStep*1000)
-                    if left < minX:
-                        contributionX -= (minX - left)/(hitmap.xStep*1000)
-
-                contributionX_extra = 0
-                if inSensitiveArea_extra:
-                    contributionX_extra = 1
-                    if right > maxX_extra:
-                        contributionX_extra -= (right - maxX_extra)/(hitmap.xStep*1000)
-                    if left < minX_extra:
-                        contributionX_extra -= (minX_extra - left)/(hitmap.xStep*1000)
-
-                if not (inSensitiveArea or inSensitiveArea_extra):
+        for epoch in range(numEpochs):
+            self.doses += [_scaledDose(epochDoses[epoch], float(weights[epoch]))]
+            self.doses_extra += [_scaledDose(epochDoses_extra[epoch], float(weights_extra[epoch]))]
+
+    def partialTotalFlux(self, shifts, integratedLuminosity, hitmap, usePadSpacing=True):
+        """Total flux summed over the epochs completed at integratedLuminosity (in fb-1), from the cumulative sums"""
+        self._epochDoses(shifts, hitmap)
+        numEpochs, _ = _partialEpochs(len(shifts), integratedLuminosity)
+        if numEpochs == 0:
+            return 0
+
+        fraction = float(_epochWeights(len(shifts), integratedLuminosity, usePadSpacing=usePadSpacing)[numEpochs-1])
+        cumulativeFlux = self._epochCache['cumulativeFlux' if usePadSpacing else 'cumulativeFlux_extra']
+        return cumulativeFlux[numEpochs-1] + fraction*(cumulativeFlux[numEpochs] - cumulativeFlux[numEpochs-1])
+
+    def _epochDoses(self, shifts, hitmap):
+        """Doses of every epoch for the shifts, calculated once and reused while the shifts and the hitmap stay the same"""
+        hitmap._checkMap()
+
+        if not self._hasEpochCache(shifts, hitmap):
+            doses = []
+            doses_extra = []
+            for shift in shifts:
+                doses += [self._rectDose(hitmap,
+                                         self.minX + shift[0],
+                                         self.maxX + shift[0],
+                                         self.minY + shift[1],
+                                         self.maxY + shift[1])]
+                doses_extra += [self._rectDose(hitmap,
+                                               self.minX_extra + shift[0],
+                                               self.maxX_extra + shift[0],
+                                               self.minY_extra + shift[1],
+                                               self.maxY_extra + shift[1])]
+            self._setEpochCache(shifts, hitmap, doses, doses_extra)
+
+        return self._epochCache['doses'], self._epochCache['doses_extra']
+
+    def _hasEpochCache(self, shifts, hitmap):
+        """Whether the cached doses of every epoch belong to these shifts and the current grid of hitmap"""
+        cache = self._epochCache
+        return (cache is not None and cache['shifts'] == tuple(tuple(shift) for shift in shifts) and
+                cache['hitmap'] is hitmap and cache['grid'] is hitmap.grid)
+
+    def _setEpochCache(self, shifts, hitmap, doses, doses_extra):
+        cumulativeFlux = [0]
+        cumulativeFlux_extra = [0]
+        for dose, dose_extra in zip(doses, doses_extra):
+            cumulativeFlux += [cumulativeFlux[-1] + dose['totalFlux']]
+            cumulativeFlux_extra += [cumulativeFlux_extra[-1] + dose_extra['totalFlux']]
+
+        self._epochCache = {
+            'shifts': tuple(tuple(shift) for shift in shifts),
+            'hitmap': hitmap,
+            'grid': hitmap.grid,
+            'doses': tuple(doses),
+            'doses_extra': tuple(doses_extra),
+            'cumulativeFlux': cumulativeFlux,
+            'cumulativeFlux_extra': cumulativeFlux_extra,
+        }
+
+    def _rectDose(self, hitmap, minX, maxX, minY, maxY):
+        """minX, maxX, minY and maxY in mm, already shifted to the hitmap frame"""
+        centerPadX = (minX + maxX)/2
+        centerPadY = (minY + maxY)/2
+
+        # Only the bins touching the pad are visited
+        xStart, xStop = _binRange(hitmap.xAxis, hitmap.xStep, minX, maxX)
+        yStart, yStop = _binRange(hitmap.yAxis, hitmap.yStep, minY, maxY)
+        yList = hitmap.yAxis[yStart:yStop].tolist()
+
+        flux = 0
+        maxFlux = None
+
+        for x, row in zip(hitmap.xAxis[xStart:xStop].tolist(), hitmap.grid[xStart:xStop, yStart:yStop].tolist()):
+            xVal = x*1000
+            left = xVal - hitmap.xStep*1000/2
+            right = xVal + hitmap.xStep*1000/2
+
+            contributionX = 1
+            if right > maxX:
+                contributionX -= (right - maxX)/(hitmap.xStep*1000)
+            if left < minX:
+                contributionX -= (minX - left)/(hitmap.xStep*1000)
+
+            for y, fluence in zip(yList, row):
+                if fluence != fluence: # NaN marks a missing entry
                     continue
 
-                for y in hitmap.map[x]:
-                    yVal = y*1000
-                    bottom = yVal - hitmap.yStep*1000/2
-                    top = yVal + hitmap.yStep*1000/2
-
-                    inSensitiveAreaY = True
-                    inSensitiveAreaY_extra = True
-
-                    if ((bottom < minY and top < minY) or
-                        (bottom > maxY and top > maxY)):
-                        inSensitiveAreaY = False
-
-                    if ((bottom < minY_extra and top < minY_extra) or
-                        (bottom > maxY_extra and top > maxY_extra)):
-                        inSensitiveAreaY_extra = False
-
-                    if inSensitiveArea and inSensitiveAreaY:
-                        contributionY = 1
-                        if top > maxY:
-                            contributionY -= (top - maxY)/(hitmap.yStep*1000)
-                        if bottom < minY:
-                            contributionY -= (minY - bottom)/(hitmap.yStep*1000)
-
-                        if epoch==len(cutshifts)-1:
-                            flux += hitmap.map[x][y] * contributionX * contributionY * floatpart
-                        else:
-                            flux += hitmap.map[x][y] * contributionX * contributionY
-
-                        if maxFlux is None or hitmap.map[x][y] > maxFlux:
-                            maxFlux = hitmap.map[x][y]
-                            
-                        if epoch==len(cutshifts)-1:
-                            fluxMap += [{
-                                'flux': hitmap.map[x][y]*floatpart,
-                                'x': xVal,
-                                'y': yVal,
-                                'xLocal': xVal - centerPadX,
-                                'yLocal': yVal - centerPadY,
-                                'leftLocal': left - centerPadX,
-                                'rightLocal': right - centerPadX,
-                                'topLocal': top - centerPadY,
-                                'bottomLocal': bottom - centerPadY,
-                            }]
-                        else:
-                            fluxMap += [{
-                                'flux': hitmap.map[x][y],
-                                'x': xVal,
-                                'y': yVal,
-                                'xLocal': xVal - centerPadX,
-                                'yLocal': yVal - centerPadY,
-                                'leftLocal': left - centerPadX,
-                                'rightLocal': right - centerPadX,
-                                'topLocal': top - centerPadY,
-                                'bottomLocal': bottom - centerPadY,
-                            }]
-                            
-
-                    if inSensitiveArea_extra and inSensitiveAreaY_extra:
-                        contributionY_extra = 1
-                        if top > maxY_extra:
-                            contributionY_extra -= (top - maxY_extra)/(hitmap.yStep*1000)
-                        if bottom < minY_extra:
-                            contributionY_extra -= (minY_extra - bottom)/(hitmap.yStep*1000)
-
-                        flux_extra += hitmap.map[x][y] * contributionX_extra * contributionY_extra
-
-                        if maxFlux_extra is None or hitmap.map[x][y] > maxFlux_extra:
-                            maxFlux_extra = hitmap.map[x][y]
-
-                        fluxMap_extra += [{
-                            'flux': hitmap.map[x][y],
-                            'x': xVal,
-                            'y': yVal,
-                            'xLocal': xVal - centerPadX_extra,
-                            'yLocal': yVal - centerPadY_extra,
-                            'leftLocal': left - centerPadX_extra,
-                            'rightLocal': right - centerPadX_extra,
-                            'topLocal': top - centerPadY_extra,
-                            'bottomLocal': bottom - centerPadY_extra,
-                        }]
-
-            occupancyNorm = (hitmap.xStep *
-                             hitmap.yStep * 1.0E4) # in cm^2
-
-            self.doses += [{
-                'totalFlux': flux,
-                'maxFlux': maxFlux,
-                'occupancyNorm': occupancyNorm,
-                'occupancy': flux * 1.6E-12 * occupancyNorm,
-                'fluxMap': fluxMap,
-                }]
-            self.doses_extra += [{
-                'totalFlux': flux_extra,
-                'maxFlux': maxFlux_extra,
-                'occupancyNorm': occupancyNorm,
-                'occupancy': flux_extra * 1.6E-12 * occupancyNorm,
-                'fluxMap': fluxMap_extra,
-                }]
+                yVal = y*1000
+                bottom = yVal - hitmap.yStep*1000/2
+                top = yVal + hitmap.yStep*1000/2
+
+                contributionY = 1
+                if top > maxY:
+                    contributionY -= (top - maxY)/(hitmap.yStep*1000)
+                if bottom < minY:
+                    contributionY -= (minY - bottom)/(hitmap.yStep*1000)
+
+                flux += fluence * contributionX * contributionY
+
+                if maxFlux is None or fluence > maxFlux:
+                    maxFlux = fluence
+
+        fluxMap = _windowFluxMap(hitmap, xStart, xStop, yStart, yStop, centerPadX, centerPadY)
+
+        occupancyNorm = (hitmap.xStep *
+                         hitmap.yStep * 1.0E4) # in cm^2
+
+        return {
+            'totalFlux': flux,
+            'maxFlux': maxFlux,
+            'occupancyNorm': occupancyNorm,
+            'occupancy': flux * 1.6E-12 * occupancyNorm,
+            'fluxMap': fluxMap,
+            }
 
     def plotFlux(self, usePadSpacing = True, printEpoch = None):
         from math import ceil
@@ -624,9 +536,6 @@ class SensorPad:
         from ROOT import kRed, kBlue  # type: ignore
         from array import array
 
-        epochLumi = float(integratedLuminosity)/self.epochs
-        #epochTime = float(maxTime)/self.epochs
-
         persistance = {}
         canv = TCanvas("dose_eol", "Dose EOL", 800, 800)
 
@@ -689,43 +598,9 @@ class SensorPad:
             persistance["pad_topEdge"].SetLineColor(kBlue)
             persistance["pad_bottomEdge"].SetLineColor(kBlue)
 
-        edgesX = []
-        edgesY = []
-        for epoch in doses:
-            xEdges = []
-            yEdges = []
-            for point in epoch['fluxMap']:
-                if point['leftLocal'] not in xEdges:
-                    xEdges += [point['leftLocal']]
-                if point['rightLocal'] not in xEdges:
-                    xEdges += [point['rightLocal']]
-                if point['topLocal'] not in yEdges:
-                    yEdges += [point['topLocal']]
-                if point['bottomLocal'] not in yEdges:
-                    yEdges += [point['bottomLocal']]
-            xEdges.sort()
-            yEdges.sort()
-
-            xEdges = cleanEdges(xEdges)
-            yEdges = cleanEdges(yEdges)
-
-            edgesX += [xEdges]
-            edgesY += [yEdges]
-
-        edgesX = summariseEdges(edgesX)
-        edgesY = summariseEdges(edgesY)
+        edgesX, edgesY, dose = self.doseEOLRaster(integratedLuminosity=integratedLuminosity, usePadSpacing=usePadSpacing)
 
-        isEmpty = False
-        if len(edgesX) <= 1 or len(edgesY) <= 1:
-            isEmpty = True
-            edgesX = [minX, maxX]
-            edgesY = [minY, maxY]
-
-        xArr, yArr = array( 'd' ), array( 'd' )
-        for edge in edgesX:
-            xArr.append(edge)
-        for edge in edgesY:
-            yArr.append(edge)
+        xArr, yArr = array( 'd', edgesX.tolist() ), array( 'd', edgesY.tolist() )
 
         numBinsX = len(xArr)-1
         numBinsY = len(yArr)-1
@@ -740,21 +615,9 @@ class SensorPad:
             print(" bins y: {}".format(numBinsY))
             raise e
 
-        if not isEmpty:
-            for binX in range(numBinsX):
-                binXPos = (edgesX[binX] + edgesX[binX+1])/2
-                for binY in range(numBinsY):
-                    binYPos = (edgesY[binY] + edgesY[binY+1])/2
-                    dose = 0
-                    for epoch in doses:
-                        for point in epoch['fluxMap']:
-                            if (binXPos > point['leftLocal']   and binXPos < point['rightLocal'] and
-                                binYPos > point['bottomLocal'] and binYPos < point['topLocal']):
-                                dose += point['flux'] * epochLumi
-                                break
-                    binx = hist.GetXaxis().FindBin(binXPos)
-                    biny = hist.GetYaxis().FindBin(binYPos)
-                    hist.SetBinContent(binx, biny, dose)
+        for binX, row in enumerate(dose.tolist()):
+            for binY, value in enumerate(row):
+                hist.SetBinContent(binX+1, binY+1, value)
 
         hist.SetStats(False)
         hist.GetXaxis().SetTitle( "x [mm]" )
@@ -778,66 +641,160 @@ class SensorPad:
         return (canv, persistance)
 
     def maxDoseEOL(self, integratedLuminosity=300, usePadSpacing = True, reuse=None):
+        """
+        integratedLuminosity in fb-1
+        reuse - (canv, persistance) from plotDoseEOL, to read the maximum from its histogram
+        """
         if reuse is not None:
-            canv = reuse[0]
-            persistance = reuse[1]
-        else:
-            canv, persistance = self.plotDoseEOL(integratedLuminosity=integratedLuminosity, usePadSpacing=usePadSpacing)
+            hist = reuse[1]['hist']
+            return hist.GetBinContent(hist.GetMaximumBin())
 
-        hist = persistance['hist']
+        edgesX, edgesY, dose = self.doseEOLRaster(integratedLuminosity=integratedLuminosity, usePadSpacing=usePadSpacing)
 
-        return hist.GetBinContent(hist.GetMaximumBin())
+        return float(dose.max())
 
-    def getVoltageEOL(self, chargeFunc, integratedLuminosity=300, usePadSpacing=True, minCharge=10, maxCharge=100, maxVolt=700):
+    def doseEOLRaster(self, integratedLuminosity=300, usePadSpacing = True):
         """
         integratedLuminosity in fb-1
-        minCharge in fC - Remember that lower charge typically carries a worse time resolution
-        maxCharge in fC - Remember that lower charge typically carries a worse time resolution
+        Returns (edgesX, edgesY, dose), the cell edges relative to the pad centre in mm and the (cells x, cells y)
+        array of the end of life dose in p/cm^2, the same cells and values as the plotDoseEOL histogram
         """
-        canv, persistance = self.plotDoseEOL(integratedLuminosity=integratedLuminosity, usePadSpacing=usePadSpacing)
+        doses = self.doses
+        if not usePadSpacing:
+            doses = self.doses_extra
 
-        hist = persistance['hist']
+        edgesX, edgesY, flux = self._epochRaster(doses, usePadSpacing=usePadSpacing)
+        epochLumi = float(integratedLuminosity)/self.epochs
 
-        binsX = hist.GetNbinsX()
-        binsY = hist.GetNbinsY()
+        return edgesX, edgesY, flux.sum(axis=0) * epochLumi
 
-        minV = None
-        maxV = None
+    def _localBounds(self, usePadSpacing=True):
+        """Pad edges relative to the pad centre, in mm"""
+        minX = self.minX
+        maxX = self.maxX
+        minY = self.minY
+        maxY = self.maxY
+        if not usePadSpacing:
+            minX = self.minX_extra
+            maxX = self.maxX_extra
+            minY = self.minY_extra
+            maxY = self.maxY_extra
 
-        allCellsWork = True
-        for x in range(1, binsX+1):
-            for y in range(1, binsY+1):
-                # TODO: add check that bin is in coverage of pad
-                phi = hist.GetBinContent(x, y)/2 # Convert from p/cm^2 to neq/cm^2
+        medX = (minX + maxX)/2
+        medY = (minY + maxY)/2
 
-                minVCell = None
-                maxVCell = None
+        return (minX - medX, maxX - medX, minY - medY, maxY - medY)
 
-                for Volt in range(1, maxVolt+1):
-                    charge = chargeFunc(Volt, phi)
-                    if minVCell is None and charge >= minCharge:
-                        minVCell = Volt
-                    if maxVCell is None and charge > maxCharge:
-                        maxVCell = Volt - 1
-                        break
+    def _epochRaster(self, doses, usePadSpacing=True):
+        """
+        Splits the pad in the cells bounded by the bin edges of all epochs (relative to the pad centre, in mm)
+        Returns (edgesX, edgesY, flux) with flux an (epochs, cells x, cells y) array of the flux seen by every
+        cell in each epoch
+        """
+        import numpy as np
 
-                if minVCell is None:
-                    allCellsWork = False
+        edgesX = []
+        edgesY = []
+        for epoch in doses:
+            fluxMap = epoch['fluxMap']
+            valid = fluxMap.fluence == fluxMap.fluence
+            xValid = valid.any(axis=1)
+            yValid = valid.any(axis=0)
+            edgesX += [mergeEdges(np.concatenate((fluxMap.leftLocal[xValid], fluxMap.rightLocal[xValid])))]
+            edgesY += [mergeEdges(np.concatenate((fluxMap.bottomLocal[yValid], fluxMap.topLocal[yValid])))]
 
-                if minV is None:
-                    minV = minVCell
-                if maxV is None:
-                    maxV = maxVCell
+        edgesX = mergeEdges(np.concatenate(edgesX)) if len(doses) != 0 else np.zeros(0)
+        edgesY = mergeEdges(np.concatenate(edgesY)) if len(doses) != 0 else np.zeros(0)
+
+        if len(edgesX) <= 1 or len(edgesY) <= 1:
+            minX, maxX, minY, maxY = self._localBounds(usePadSpacing)
+            return np.array([minX, maxX]), np.array([minY, maxY]), np.zeros((len(doses), 1, 1))
+
+        centersX = (edgesX[:-1] + edgesX[1:])/2
+        centersY = (edgesY[:-1] + edgesY[1:])/2
+
+        flux = np.zeros((len(doses), len(centersX), len(centersY)))
+        for epoch, dose in enumerate(doses):
+            fluxMap = dose['fluxMap']
+            if fluxMap.fluence.size == 0:
+                continue
+            # Bin of the epoch holding the centre of every cell, the centre must be strictly inside it
+            xIdx, xInside = _cellBins(fluxMap.leftLocal, fluxMap.rightLocal, centersX)
+            yIdx, yInside = _cellBins(fluxMap.bottomLocal, fluxMap.topLocal, centersY)
+            epochFlux = np.nan_to_num(fluxMap.flux[np.ix_(xIdx, yIdx)])
+            flux[epoch] = epochFlux * xInside[:, None] * yInside[None, :]
+
+        return edgesX, edgesY, flux
+
+    def voltageWindowVsLuminosity(self, chargeFunc, luminosities, usePadSpacing=True, minCharge=10, maxCharge=100, maxVolt=700,
+                                  solver="grid", integerVolts=True, cacheKey=None):
+        """
+        luminosities in fb-1, the doses of every epoch must have been calculated before (calculateFlux)
+        Returns (lumi, minV, maxV) arrays with the getVoltageEOL window after a calculatepartialFlux at every
+        luminosity, NaN where getVoltageEOL gives None
+        """
+        import numpy as np
+        from .ChargeSolver import cellVoltageWindows, padVoltageWindow
+
+        if self._epochCache is None:
+            raise RuntimeError("You must calculate the fluxes before scanning the luminosity")
+
+        epochDoses = self._epochCache['doses' if usePadSpacing else 'doses_extra']
+        numShifts = len(epochDoses)
+
+        lumi = np.asarray(luminosities, dtype=np.float64)
+        minV = np.full(len(lumi), np.nan)
+        maxV = np.full(len(lumi), np.nan)
+
+        rasters = {}
+        for idx, integratedLuminosity in enumerate(lumi.tolist()):
+            numEpochs, _ = _partialEpochs(numShifts, integratedLuminosity)
+            # The cells only depend on which epochs have started, so the rasters are shared between luminosities
+            if numEpochs not in rasters:
+                rasters[numEpochs] = self._epochRaster(epochDoses[:numEpochs], usePadSpacing=usePadSpacing)
+            flux = rasters[numEpochs][2]
+
+            weights = _epochWeights(numShifts, integratedLuminosity, usePadSpacing=usePadSpacing)[:numEpochs]
+            epochLumi = float(integratedLuminosity)/self.epochs
+            dose = np.tensordot(weights, flux, axes=1) * epochLumi if numEpochs > 0 else np.zeros(flux.shape[1:])
+
+            phi = dose/2 # Convert from p/cm^2 to neq/cm^2
+            cellMinV, cellMaxV = cellVoltageWindows(chargeFunc, phi, minCharge=minCharge, maxCharge=maxCharge, maxVolt=maxVolt,
+                                                    solver=solver, integerVolts=integerVolts, cacheKey=cacheKey)
+            padMinV, padMaxV = padVoltageWindow(cellMinV, cellMaxV, integerVolts=integerVolts)
+            if padMinV is not None:
+                minV[idx] = padMinV
+            if padMaxV is not None:
+                maxV[idx] = padMaxV
+
+        return lumi, minV, maxV
+
+    def getVoltageEOL(self, chargeFunc, integratedLuminosity=300, usePadSpacing=True, minCharge=10, maxCharge=100, maxVolt=700,
+                      solver="grid", integerVolts=True, returnCells=False, cacheKey=None):
+        """
+        integratedLuminosity in fb-1
+        minCharge in fC - Remember that lower charge typically carries a worse time resolution
+        maxCharge in fC - Remember that lower charge typically carries a worse time resolution
+        solver - "grid" evaluates chargeFunc on every whole volt up to maxVolt, for all the cells at once
+                 "bisect" finds the window by bisection, only valid if the charge increases with the voltage
+                 "table" interpolates a cached inverse of chargeFunc (see ChargeSolver.chargeInverseTable), fastest
+                 for repeated calls, same assumption as "bisect" and approximate within the table spacing: the
+                 whole volt window of about 1% of the cells is 1 V (at most 2 V) off the "grid" one
+        integerVolts - whole volt window, as in the original scan, otherwise the crossing points (bisect and table)
+        cacheKey - hashable key of chargeFunc and its parameters for the "table" solver, only needed to reuse the table
+                   when chargeFunc reads objects that can not be compared by value (see ChargeSolver.chargeInverseTable)
+        returnCells - also return the (cells x, cells y) arrays of the window of every cell, NaN where there is none
+        """
+        import numpy as np
+        from .ChargeSolver import cellVoltageWindows, padVoltageWindow
 
-                if minVCell is not None and minV is not None:
-                    if minVCell > minV:
-                        minV = minVCell
-                if maxVCell is not None and maxV is not None:
-                    if maxVCell < maxV:
-                        maxV = maxVCell
+        edgesX, edgesY, dose = self.doseEOLRaster(integratedLuminosity=integratedLuminosity, usePadSpacing=usePadSpacing)
+        phi = dose/2 # Convert from p/cm^2 to neq/cm^2
 
-        if not allCellsWork:
-            minV = None
-            maxV = None
+        cellMinV, cellMaxV = cellVoltageWindows(chargeFunc, phi, minCharge=minCharge, maxCharge=maxCharge, maxVolt=maxVolt,
+                                                solver=solver, integerVolts=integerVolts, cacheKey=cacheKey)
+        minV, maxV = padVoltageWindow(cellMinV, cellMaxV, integerVolts=integerVolts)
 
-        return (minV, maxV)
\ No newline at end of file
+        if returnCells:
+            return (minV, maxV, cellMinV, cellMaxV)
+        return (minV, maxV)
@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+class TiledGrid:
+    """
+    Read only 2D grid stored as fixed size tiles in a .npy file, see TiledGrid.save
+    The file is memory mapped and a tile is only read the first time one of its bins is accessed, at most maxTiles
+    tiles are kept, the least recently used ones are dropped first
+    Indexing works as for a numpy array and only reads the tiles holding the requested bins, converting it with
+    np.asarray reads the whole grid
+    """
+    def __init__(self,
+                 filename, # .npy file written by TiledGrid.save
+                 shape, # (x bins, y bins) of the grid, the tiles are padded past it
+                 maxTiles = 256 # Number of tiles kept in memory
+                ):
+        from collections import OrderedDict
+
+        self.filename = filename
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.maxTiles = maxTiles
+        self._tiles = None # Memory map of the (x tiles, y tiles, tile bins, tile bins) array, opened on first use
+        self._loaded = OrderedDict()
+
+    @staticmethod
+    def _create(filename, shape, tileSize):
+        """Memory map of a new tile file for a grid of the given shape, the tiles are filled with NaN"""
+        import numpy as np
+
+        tiles = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float64,
+                                          shape=(-(-shape[0]//tileSize), -(-shape[1]//tileSize), tileSize, tileSize))
+        tiles[...] = np.nan
+        return tiles
+
+    @staticmethod
+    def _writeBand(tiles, xStart, band):
+        """Writes the grid rows from xStart, a multiple of the tile size, to the tiles"""
+        tileSize = tiles.shape[2]
+        for i in range(0, band.shape[0], tileSize):
+            rows = band[i:i+tileSize]
+            for j in range(tiles.shape[1]):
+                tile = rows[:, j*tileSize:(j+1)*tileSize]
+                tiles[(xStart + i)//tileSize, j, :tile.shape[0], :tile.shape[1]] = tile
+
+    @staticmethod
+    def save(filename, grid, tileSize):
+        """Writes grid as tiles of tileSize x tileSize bins, each tile contiguous in the file, the padding is NaN"""
+        import numpy as np
+
+        grid = np.asarray(grid, dtype=np.float64)
+        tiles = TiledGrid._create(filename, grid.shape, tileSize)
+        TiledGrid._writeBand(tiles, 0, grid)
+        tiles.flush()
+        del tiles
+
+    def summedArea(self, filename):
+        """
+        Writes the summed-area table of the grid (missing bins count as 0) to filename with the same tiles, one band
+        of tiles at a time, entry [i, j] is the sum of all bins below i in x and below j in y
+        Returns it as a TiledGrid, the sums are the same as np.cumsum over the whole grid
+        """
+        import numpy as np
+
+        size = self.tileSize
+        shape = (self.shape[0] + 1, self.shape[1] + 1)
+        tiles = TiledGrid._create(filename, shape, size)
+
+        # Row k of the table sums the grid rows below k, carry holds the column sums of the rows before the band
+        carry = np.zeros(self.shape[1])
+        for xStart in range(0, shape[0], size):
+            xStop = min(xStart + size, shape[0])
+            rows = np.nan_to_num(self[max(xStart - 1, 0):xStop - 1, :])
+            sums = np.cumsum(np.vstack([carry[None, :], rows]), axis=0)
+            carry = sums[-1]
+
+            band = np.zeros((xStop - xStart, shape[1]))
+            band[xStop - xStart - len(rows):, 1:] = sums[1:]
+            np.cumsum(band[:, 1:], axis=1, out=band[:, 1:])
+            TiledGrid._writeBand(tiles, xStart, band)
+
+        tiles.flush()
+        del tiles
+        return TiledGrid(filename, shape, maxTiles=self.maxTiles)
+
+    def blockReduce(self, filename, xPower, yPower, reduce):
+        """
+        Writes the max (or min) of the grid over every block of 2**xPower by 2**yPower bins (NaN entries are ignored)
+        to filename with the same tiles, one band of tiles at a time, entry [i, j] covers the bins from i and j on
+        Returns it as a TiledGrid
+        """
+        import numpy as np
+
+        op = np.fmax if reduce == "max" else np.fmin
+        size = self.tileSize
+        shape = (max(0, self.shape[0] - 2**xPower + 1), max(0, self.shape[1] - 2**yPower + 1))
+        tiles = TiledGrid._create(filename, shape, size)
+
+        for xStart in range(0, shape[0], size):
+            xStop = min(xStart + size, shape[0])
+            # The band needs the 2**xPower - 1 rows after it
+            block = self[xStart:xStop + 2**xPower - 1, :]
+            for power in range(xPower):
+                block = op(block[:-2**power], block[2**power:])
+            for power in range(yPower):
+                block = op(block[:, :-2**power], block[:, 2**power:])
+            TiledGrid._writeBand(tiles, xStart, block)
+
+        tiles.flush()
+        del tiles
+        return TiledGrid(filename, shape, maxTiles=self.maxTiles)
+
+    @property
+    def tiles(self):
+        import numpy as np
+
+        if self._tiles is None:
+            self._tiles = np.load(self.filename, mmap_mode='r')
+        return self._tiles
+
+    @property
+    def tileSize(self):
+        return int(self.tiles.shape[2])
+
+    @property
+    def loadedTiles(self):
+        """Number of tiles currently held in memory"""
+        return len(self._loaded)
+
+    @property
+    def dtype(self):
+        import numpy as np
+        return np.dtype(np.float64)
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def size(self):
+        return self.shape[0]*self.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.size*self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getstate__(self):
+        # The memory map and the loaded tiles are opened again in the new process
+        from collections import OrderedDict
+
+        state = self.__dict__.copy()
+        state['_tiles'] = None
+        state['_loaded'] = OrderedDict()
+        return state
+
+    def _tile(self, i, j):
+        import numpy as np
+
+        if (i, j) in self._loaded:
+            self._loaded.move_to_end((i, j))
+        else:
+            self._loaded[(i, j)] = np.array(self.tiles[i, j])
+            while len(self._loaded) > self.maxTiles:
+                self._loaded.popitem(last=False)
+        return self._loaded[(i, j)]
+
+    def release(self):
+        """Forgets the loaded tiles, they are read again from the file when needed"""
+        self._loaded.clear()
+
+    def _block(self, xStart, xStop, yStart, yStop):
+        """Copy of the bins [xStart, xStop) x [yStart, yStop), only reading the tiles that overlap them"""
+        import numpy as np
+
+        block = np.empty((xStop - xStart, yStop - yStart))
+        size = self.tileSize
+        for i in range(xStart//size, -(-xStop//size)):
+            x0 = max(xStart, i*size)
+            x1 = min(xStop, (i+1)*size)
+            for j in range(yStart//size, -(-yStop//size)):
+                y0 = max(yStart, j*size)
+                y1 = min(yStop, (j+1)*size)
+                block[x0-xStart:x1-xStart, y0-yStart:y1-yStart] = self._tile(i, j)[x0-i*size:x1-i*size, y0-j*size:y1-j*size]
+        return block
+
+    def _points(self, xIdx, yIdx):
+        """Bins at the (xIdx, yIdx) pairs, arrays of the same shape, reading every tile involved once"""
+        import numpy as np
+
+        size = self.tileSize
+        flatX = xIdx.ravel()
+        flatY = yIdx.ravel()
+        values = np.empty(len(flatX))
+
+        tileIds = (flatX//size)*(-(-self.shape[1]//size)) + flatY//size
+        order = np.argsort(tileIds, kind='stable')
+        tileIds, starts = np.unique(tileIds[order], return_index=True)
+        for tileId, start, stop in zip(tileIds.tolist(), starts.tolist(), starts[1:].tolist() + [len(order)]):
+            points = order[start:stop]
+            i, j = divmod(tileId, -(-self.shape[1]//size))
+            values[points] = self._tile(i, j)[flatX[points] - i*size, flatY[points] - j*size]
+        return values.reshape(xIdx.shape)
+
+    @staticmethod
+    def _axisKey(key, length):
+        """(start, stop, key relative to start) of the bins selected by key along an axis of the given length"""
+        import numpy as np
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(length)
+            selected = range(start, stop, step)
+            if len(selected) == 0:
+                return 0, 0, slice(0, 0)
+            low = min(selected[0], selected[-1])
+            relStop = stop - low
+            return low, max(selected[0], selected[-1]) + 1, slice(start - low, relStop if relStop >= 0 else None, step)
+
+        if isinstance(key, (int, np.integer)):
+            if key < -length or key >= length:
+                raise IndexError("Index {} is out of bounds for an axis of size {}".format(key, length))
+            key = int(key) % length
+            return key, key + 1, 0
+
+        key = np.asarray(key)
+        if key.dtype == bool:
+            if key.shape != (length,):
+                raise IndexError("Boolean index of shape {} does not match an axis of size {}".format(key.shape, length))
+            key = np.nonzero(key)[0]
+        if not np.issubdtype(key.dtype, np.integer):
+            raise IndexError("Only integers, slices and integer or boolean arrays are valid indices")
+        if key.size == 0:
+            return 0, 0, key
+        if key.min() < -length or key.max() >= length:
+            raise IndexError("Index is out of bounds for an axis of size {}".format(length))
+        key = key % length
+        return int(key.min()), int(key.max()) + 1, key - key.min()
+
+    def __getitem__(self, key):
+        import numpy as np
+
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        if len(key) != 2:
+            raise IndexError("TiledGrid is indexed as [x, y]")
+
+        xStart, xStop, xKey = self._axisKey(key[0], self.shape[0])
+        yStart, yStop, yKey = self._axisKey(key[1], self.shape[1])
+        if isinstance(xKey, np.ndarray) and isinstance(yKey, np.ndarray):
+            # Pairs of bins, possibly spread over the whole grid, only their tiles are read
+            xIdx, yIdx = np.broadcast_arrays(xKey + xStart, yKey + yStart)
+            return self._points(xIdx, yIdx)
+        return self._block(xStart, xStop, yStart, yStop)[xKey, yKey]
+
+    def __array__(self, dtype=None, copy=None):
+        grid = self._block(0, self.shape[0], 0, self.shape[1])
+        if dtype is not None:
+            grid = grid.astype(dtype)
+        return grid
+
+    def tolist(self):
+        return self.__array__().tolist()
@@ -2,13 +2,23 @@ __version__ = '0.0.2'
 
 from .PPSHitmap import PPSHitmap
 from .SensorPad import SensorPad
+from .FluxMap import FluxMap
+from .TiledGrid import TiledGrid
+from .MapView import MapView
 from .Sensor import Sensor
 from .Sensor import calcLossProb
+from .ChargeSolver import chargeInverseTable
+from .LayoutComparison import compareLayouts
 from .CustomizedSensors import *
 
 __all__ = [
     "PPSHitmap",
     "SensorPad",
+    "FluxMap",
+    "TiledGrid",
+    "MapView",
     "Sensor",
     "calcLossProb",
+    "chargeInverseTable",
+    "compareLayouts",
 ]
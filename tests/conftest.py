@@ -0,0 +1,67 @@
+import os
+import sys
+from math import e
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pps_hitmaps.Sensor import Sensor
+from pps_hitmaps.SensorPad import SensorPad
+
+# Synthetic hitmap in m, small enough for the original per bin loops to stay fast
+X_MIN, X_MAX, X_STEP = 0.0, 0.006, 0.00005
+Y_MIN, Y_MAX, Y_STEP = -0.004, 0.004, 0.00005
+
+def syntheticFluence(x, y):
+    """Smooth fluence in p/(cm^2 fb-1), falling away from the beam, with a bump so the maximum is not at a corner"""
+    return (1e15*np.exp(-x/0.0015)*np.exp(-(y/0.002)**2) +
+            2e14*np.exp(-((x - 0.003)/0.0005)**2 - ((y + 0.001)/0.0008)**2) + 1e13)
+
+SHIFTS = [(2.0, 0.0), (2.0, -0.5), (2.5, 0.3)]
+
+class SmallSensor(Sensor):
+    """4 x 4 pads around the origin, small enough to stay inside the synthetic map with SHIFTS"""
+    def __init__(self, shifts:list = [], PadSize = 0.6, PadSpacing = 0.1):
+        Sensor.__init__(self, shifts=shifts)
+
+        SensitiveEdge = -PadSize*2
+        for x in range(4):
+            for y in range(4):
+                self.padVec += [SensorPad(epochs = len(shifts),
+                                          minX = SensitiveEdge + x*PadSize + PadSpacing/2,
+                                          maxX = SensitiveEdge + (x+1)*PadSize - PadSpacing/2,
+                                          minY = SensitiveEdge + y*PadSize + PadSpacing/2,
+                                          maxY = SensitiveEdge + (y+1)*PadSize - PadSpacing/2,
+                                          extra = PadSpacing/2)]
+
+        self.numPads = len(self.padVec)
+
+def VoltFunc(Volt, Phi):
+    Phi = Phi/1e16
+    return (2.0 + 3.0*e**(-Phi/5.0))*e**(Volt/(60 + 20*Phi))
+
+def writeHitmap(filename):
+    xs = np.round(np.arange(X_MIN, X_MAX + X_STEP/2, X_STEP), 6)
+    ys = np.round(np.arange(Y_MIN, Y_MAX + Y_STEP/2, Y_STEP), 6)
+    with open(filename, 'w') as file:
+        for x in xs:
+            for y in ys:
+                file.write("{} {} {!r}\n".format(x, y, float(syntheticFluence(x, y))))
+
+@pytest.fixture(scope="session")
+def hitmapFile(tmp_path_factory):
+    filename = str(tmp_path_factory.mktemp("hitmaps") / "synthetic.out")
+    writeHitmap(filename)
+    return filename
+
+@pytest.fixture
+def makeHitmap(hitmapFile):
+    from pps_hitmaps import PPSHitmap
+
+    def make(filename=hitmapFile, **kwargs):
+        hitmap = PPSHitmap(filename, "234", 1.0, xMin=X_MIN, xMax=X_MAX, xStep=X_STEP, yMin=Y_MIN, yMax=Y_MAX, yStep=Y_STEP, **kwargs)
+        hitmap.validate()
+        return hitmap
+    return make
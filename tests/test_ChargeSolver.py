@@ -0,0 +1,64 @@
+import math
+
+import numpy as np
+import pytest
+
+from pps_hitmaps.ChargeSolver import cellVoltageWindows
+from pps_hitmaps.SensorPad import SensorPad
+
+def overflowingCharge(Volt, Phi):
+    # Only works on scalars and overflows well above the maximum charge at low fluence
+    return 5*math.exp(Volt/(0.5 + 1e-16*Phi))
+
+def scanWindow(chargeFunc, phi, minCharge=10, maxCharge=100, maxVolt=700):
+    """Voltage scan of the original getVoltageEOL for one cell, stopping above the maximum charge"""
+    minV = None
+    maxV = None
+    for Volt in range(1, maxVolt+1):
+        charge = chargeFunc(Volt, phi)
+        if minV is None and charge >= minCharge:
+            minV = Volt
+        if maxV is None and charge > maxCharge:
+            maxV = Volt - 1
+            break
+    return minV, maxV
+
+def asWindow(value):
+    return None if np.isnan(value) else int(value)
+
+def test_grid_solver_handles_overflow():
+    phi = np.array([0., 1e14, 1e16, 5e16, 1e17, 2e17, 4e17])
+    minV, maxV = cellVoltageWindows(overflowingCharge, phi, solver="grid")
+    for value, low, high in zip(phi.tolist(), minV.tolist(), maxV.tolist()):
+        assert (asWindow(low), asWindow(high)) == scanWindow(overflowingCharge, value)
+
+def test_pad_voltage_window_handles_overflow(makeHitmap):
+    hitmap = makeHitmap()
+    pad = SensorPad(epochs=2, minX=0.2, maxX=1.5, minY=-0.65, maxY=0.65, extra=0.05)
+    shifts = [(0.5, 0.), (0.5, -0.4)]
+    pad.calculateFlux(shifts, hitmap)
+
+    # At low luminosity the charge overflows below 700 V
+    edgesX, edgesY, dose = pad.doseEOLRaster(integratedLuminosity=3)
+    cells = [scanWindow(overflowingCharge, phi) for phi in (dose/2).ravel().tolist()]
+    expected = (None, None)
+    if all(minV is not None for minV, maxV in cells):
+        expected = (max(minV for minV, maxV in cells), min((maxV for minV, maxV in cells if maxV is not None), default=None))
+
+    assert pad.getVoltageEOL(overflowingCharge, integratedLuminosity=3, solver="grid") == expected
+
+@pytest.mark.parametrize("solver", ["bisect", "table"])
+def test_monotonic_solvers_handle_overflow(solver):
+    phi = np.linspace(0, 4e17, 41)
+    gridMinV, gridMaxV = cellVoltageWindows(overflowingCharge, phi, solver="grid")
+    minV, maxV = cellVoltageWindows(overflowingCharge, phi, solver=solver)
+
+    np.testing.assert_array_equal(np.isnan(minV), np.isnan(gridMinV))
+    np.testing.assert_array_equal(np.isnan(maxV), np.isnan(gridMaxV))
+    if solver == "bisect":
+        np.testing.assert_array_equal(minV, gridMinV)
+        np.testing.assert_array_equal(maxV, gridMaxV)
+    else:
+        # Interpolated, within a couple of volts of the scan
+        assert np.nanmax(np.abs(minV - gridMinV)) <= 2
+        assert np.nanmax(np.abs(maxV - gridMaxV)) <= 2
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from conftest import SHIFTS, SmallSensor, VoltFunc
+from pps_hitmaps.LayoutComparison import compareLayouts
+
+@pytest.mark.parametrize("usePadSpacing", [True, False])
+def test_compareLayouts_matches_each_sensor(makeHitmap, usePadSpacing):
+    hitmap = makeHitmap()
+    designs = [SmallSensor, ("Wide", SmallSensor, {'PadSize': 0.8})]
+    schedules = {'base': SHIFTS, 'two': SHIFTS[:2]}
+
+    rows = compareLayouts(designs, hitmap, schedules, chargeFunc=VoltFunc, integratedLuminosity=250, usePadSpacing=usePadSpacing)
+
+    expected = []
+    for scheduleName, shifts in schedules.items():
+        for name, kwargs in (("SmallSensor", {}), ("Wide", {'PadSize': 0.8})):
+            sensor = SmallSensor(shifts, **kwargs)
+            sensor.calculateFlux(hitmap)
+            maxOccupancy = np.nanmax(sensor.occupancyMatrix(usePadSpacing=usePadSpacing), axis=0)
+            minV, maxV = sensor.getVoltageEOL(VoltFunc, usePadSpacing=usePadSpacing, integratedLuminosity=250)
+            for epoch in range(len(shifts)):
+                expected += [(name, scheduleName, epoch, maxOccupancy[epoch],
+                              sensor.maxDoseEOL(integratedLuminosity=250, usePadSpacing=usePadSpacing), minV, maxV)]
+
+    assert len(rows) == len(expected)
+    for row, (name, scheduleName, epoch, maxOccupancy, maxDose, minV, maxV) in zip(rows, expected):
+        assert (row['design'], row['schedule'], row['epoch']) == (name, scheduleName, epoch)
+        assert row['maxOccupancy'] == pytest.approx(maxOccupancy, rel=1e-9)
+        assert row['maxDoseEOL'] == maxDose
+        assert (row['minVoltage'], row['maxVoltage']) == (minV, maxV)
+
+def test_compareLayouts_without_chargeFunc(makeHitmap):
+    rows = compareLayouts([SmallSensor], makeHitmap(), [SHIFTS])
+
+    assert [row['epoch'] for row in rows] == [0, 1, 2]
+    assert all(row['minVoltage'] is None and row['maxVoltage'] is None for row in rows)
@@ -0,0 +1,170 @@
+import shutil
+
+import numpy as np
+import pytest
+
+from conftest import X_STEP, Y_STEP
+
+def loadMapDict(filename):
+    """The {x: {y: fluence}} dict the original _loadMap built"""
+    hitmap = {}
+    with open(filename) as file:
+        for line in file:
+            pLine = [float(x) for x in line.rstrip().split(' ')]
+            if pLine[0] not in hitmap:
+                hitmap[pLine[0]] = {}
+            hitmap[pLine[0]][pLine[1]] = pLine[2]
+    return hitmap
+
+def loopIntegrate(mapDict, xStep, yStep, leftPad, rightPad, bottomPad, topPad):
+    """Sum of the fluence of every bin weighted by the fraction of the bin inside the rectangle, bin by bin"""
+    fluence = 0
+    for xVal, column in mapDict.items():
+        left = xVal - xStep/2
+        right = xVal + xStep/2
+        if right <= leftPad or left >= rightPad:
+            continue
+        contributionX = 1
+        if right > rightPad:
+            contributionX -= (right - rightPad)/xStep
+        if left < leftPad:
+            contributionX -= (leftPad - left)/xStep
+
+        for yVal, value in column.items():
+            bottom = yVal - yStep/2
+            top = yVal + yStep/2
+            if top <= bottomPad or bottom >= topPad:
+                continue
+            contributionY = 1
+            if top > topPad:
+                contributionY -= (top - topPad)/yStep
+            if bottom < bottomPad:
+                contributionY -= (bottomPad - bottom)/yStep
+            fluence += value * contributionX * contributionY
+    return fluence
+
+@pytest.fixture(scope="module")
+def mapDict(hitmapFile):
+    return loadMapDict(hitmapFile)
+
+@pytest.fixture
+def hitmapCopy(hitmapFile, tmp_path):
+    """Copy of the synthetic map in its own directory, for the files written next to it"""
+    filename = str(tmp_path / "synthetic.out")
+    shutil.copy(hitmapFile, filename)
+    return filename
+
+def test_map_matches_original_dict(makeHitmap, mapDict):
+    hitmap = makeHitmap()
+
+    assert sorted(hitmap.map) == sorted(mapDict)
+    for x, column in mapDict.items():
+        assert dict(hitmap.map[x]) == column
+
+def test_map_is_read_only(makeHitmap):
+    hitmap = makeHitmap()
+    x = next(iter(hitmap.map))
+    y = next(iter(hitmap.map[x]))
+
+    with pytest.raises(TypeError):
+        hitmap.map[x] = {}
+    with pytest.raises(TypeError):
+        hitmap.map[x][y] = 0.
+
+@pytest.mark.parametrize("rect", [
+    (0.0011, 0.0024, -0.00133, 0.00071), # Partial bins on every side
+    (0.000025, 0.001325, -0.00065, 0.00065), # Aligned on the bin edges in x
+    (0.00301, 0.00302, -0.00101, -0.001), # Inside a single bin
+    (-0.001, 0.0005, -0.005, 0.005), # Past the edges of the map
+])
+def test_integrateRect_matches_loop(makeHitmap, mapDict, rect):
+    hitmap = makeHitmap()
+
+    assert hitmap.integrateRect(*rect) == pytest.approx(loopIntegrate(mapDict, X_STEP, Y_STEP, *rect), rel=1e-9)
+
+def test_integrateRect_broadcasts(makeHitmap):
+    hitmap = makeHitmap()
+    xmin = np.array([0.0011, 0.002, 0.003])
+    ymin = np.array([[-0.001], [0.0005]])
+
+    fluence = hitmap.integrateRect(xmin, xmin + 0.0013, ymin, ymin + 0.0013)
+
+    assert fluence.shape == (2, 3)
+    for i in range(2):
+        for j in range(3):
+            assert fluence[i, j] == pytest.approx(hitmap.integrateRect(xmin[j], xmin[j] + 0.0013, ymin[i, 0], ymin[i, 0] + 0.0013), rel=1e-12)
+
+def test_integratePadOccupancy_matches_loop(makeHitmap, mapDict):
+    hitmap = makeHitmap()
+    xLen, yLen = 0.0013, 0.00071
+    maxFluence = hitmap.maxFluence
+
+    leftPad = maxFluence["x"] - X_STEP/2
+    bottomPad = maxFluence["y"] - yLen/2
+    fluence = loopIntegrate(mapDict, X_STEP, Y_STEP, leftPad, leftPad + xLen, bottomPad, bottomPad + yLen)
+
+    assert hitmap.integratePadOccupancy(xLen, yLen) == pytest.approx(fluence * 1.6E-12 * (X_STEP * Y_STEP) * 1.0E4, rel=1e-9)
+
+@pytest.mark.parametrize("reduce, nanReduce", [("max", np.nanmax), ("min", np.nanmin)])
+def test_rangeReduce_matches_slices(makeHitmap, reduce, nanReduce):
+    hitmap = makeHitmap()
+    grid = np.array(hitmap.grid)
+    grid[10:14, 20:90] = np.nan # Missing entries are ignored
+    hitmap.grid = grid
+
+    rng = np.random.default_rng(1)
+    xStart = rng.integers(0, grid.shape[0], 200)
+    yStart = rng.integers(0, grid.shape[1], 200)
+    xStop = np.minimum(xStart + rng.integers(1, 40, 200), grid.shape[0])
+    yStop = np.minimum(yStart + rng.integers(1, 40, 200), grid.shape[1])
+
+    result = hitmap._rangeReduce(xStart, xStop, yStart, yStop, reduce=reduce)
+
+    for i in range(200):
+        window = grid[xStart[i]:xStop[i], yStart[i]:yStop[i]]
+        if np.isnan(window).all():
+            assert np.isnan(result[i])
+        else:
+            assert result[i] == nanReduce(window)
+    assert np.isnan(hitmap._rangeReduce([5], [5], [0], [10], reduce=reduce)).all() # Empty window
+
+def test_cache_round_trip(makeHitmap, hitmapCopy):
+    from pps_hitmaps import PPSHitmap
+
+    parsed = makeHitmap(filename=hitmapCopy, cache=True)
+
+    cached = PPSHitmap(hitmapCopy, "234", 1.0, xMin=parsed.xMin, xMax=parsed.xMax, xStep=X_STEP,
+                       yMin=parsed.yMin, yMax=parsed.yMax, yStep=Y_STEP, cache=True)
+    cached._checkMap()
+
+    assert cached.validated # Only possible through the cache, validate() was not called
+    np.testing.assert_array_equal(cached.grid, parsed.grid)
+    np.testing.assert_array_equal(cached.xAxis, parsed.xAxis)
+    np.testing.assert_array_equal(cached.yAxis, parsed.yAxis)
+    assert cached.maxFluence == parsed.maxFluence
+    assert cached.getMaxFluence(0.003) == parsed.getMaxFluence(0.003)
+
+def test_tiled_grid_matches_dense(makeHitmap, hitmapCopy):
+    dense = makeHitmap()
+    tiled = makeHitmap(filename=hitmapCopy, tileSize=16)
+
+    np.testing.assert_array_equal(np.asarray(tiled.grid), dense.grid)
+    assert tiled.maxFluence == dense.maxFluence
+
+    rect = (np.array([0.0011, 0.0023]), np.array([0.0024, 0.0041]), -0.00133, 0.00071)
+    np.testing.assert_allclose(tiled.integrateRect(*rect), dense.integrateRect(*rect), rtol=1e-12)
+
+    xStart, yStart = np.array([0, 17, 40]), np.array([3, 50, 100])
+    for reduce in ("max", "min"):
+        np.testing.assert_array_equal(tiled._rangeReduce(xStart, xStart + 33, yStart, yStart + 20, reduce=reduce),
+                                      dense._rangeReduce(xStart, xStart + 33, yStart, yStart + 20, reduce=reduce))
+
+def test_pyramidLevel_keeps_integrals(makeHitmap):
+    hitmap = makeHitmap()
+    coarse = hitmap.pyramidLevel(2)
+
+    # A rectangle on the coarse bin edges covers the same fine bins
+    xmin = coarse.xAxis[3] - coarse.xStep/2
+    ymin = coarse.yAxis[5] - coarse.yStep/2
+    rect = (xmin, xmin + 10*coarse.xStep, ymin, ymin + 7*coarse.yStep)
+    assert coarse.integrateRect(*rect) * coarse.xStep * coarse.yStep == pytest.approx(hitmap.integrateRect(*rect) * X_STEP * Y_STEP, rel=1e-9)
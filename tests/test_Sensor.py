@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from conftest import SHIFTS, X_MIN, X_MAX, X_STEP, Y_MIN, Y_MAX, Y_STEP, SmallSensor, VoltFunc
+from pps_hitmaps import PPSHitmap
+
+def padLoopFlux(sensor, hitmap):
+    """Flux of every pad from its own loop over the bins, as calculateFlux did before the batch"""
+    for pad in sensor.padVec:
+        pad.calculateFlux(sensor.shifts, hitmap)
+    sensor.hasFlux = True
+    return sensor
+
+@pytest.fixture(scope="module")
+def hitmap(hitmapFile):
+    hitmap = PPSHitmap(hitmapFile, "234", 1.0, xMin=X_MIN, xMax=X_MAX, xStep=X_STEP, yMin=Y_MIN, yMax=Y_MAX, yStep=Y_STEP)
+    hitmap.validate()
+    return hitmap
+
+@pytest.fixture(scope="module")
+def loopSensor(hitmap):
+    return padLoopFlux(SmallSensor(SHIFTS), hitmap)
+
+def test_calculateFlux_matches_pad_loop(hitmap, loopSensor):
+    sensor = SmallSensor(SHIFTS)
+    sensor.calculateFlux(hitmap)
+
+    assert sensor._fluxPads() == list(range(16))
+    for pad, loopPad in zip(sensor.padVec, loopSensor.padVec):
+        for doses, loopDoses in ((pad.doses, loopPad.doses), (pad.doses_extra, loopPad.doses_extra)):
+            for dose, loopDose in zip(doses, loopDoses):
+                assert dose['totalFlux'] == pytest.approx(loopDose['totalFlux'], rel=1e-9)
+                assert dose['occupancy'] == pytest.approx(loopDose['occupancy'], rel=1e-9)
+                assert dose['maxFlux'] == loopDose['maxFlux']
+                np.testing.assert_array_equal(dose['fluxMap'].toArray(), loopDose['fluxMap'].toArray())
+
+@pytest.mark.parametrize("usePadSpacing", [True, False])
+def test_roi_matches_all_pads(hitmap, loopSensor, usePadSpacing):
+    sensor = SmallSensor(SHIFTS)
+
+    sensor.calculateFlux(hitmap, roi="dose")
+    assert len(sensor._fluxPads()) < 16
+    assert sensor.maxDoseEOL(usePadSpacing=usePadSpacing) == loopSensor.maxDoseEOL(usePadSpacing=usePadSpacing)
+
+    sensor.calculateFlux(hitmap, roi="voltage")
+    assert sensor.getVoltageEOL(VoltFunc, usePadSpacing=usePadSpacing) == loopSensor.getVoltageEOL(VoltFunc, usePadSpacing=usePadSpacing)
+
+    sensor.calculateFlux(hitmap, roi="occupancy")
+    np.testing.assert_allclose(np.nanmax(sensor.occupancyMatrix(usePadSpacing=usePadSpacing), axis=0),
+                               np.nanmax(loopSensor.occupancyMatrix(usePadSpacing=usePadSpacing), axis=0), rtol=1e-9)
+
+def test_numberofPads_uses_the_extreme_pads(loopSensor):
+    window = loopSensor.getVoltageEOL(VoltFunc)
+
+    doses = [pad.maxDoseEOL() for pad in loopSensor.padVec]
+    order = np.argsort(doses)
+    windows = [loopSensor.padVec[i].getVoltageEOL(VoltFunc) for i in order.tolist()]
+    minV = max(minV for minV, maxV in windows[-4:])
+    maxV = min(maxV for minV, maxV in windows[-4:] + windows[:4] if maxV is not None)
+
+    assert loopSensor.getVoltageEOL(VoltFunc, numberofPads=4) == (minV, maxV)
+    assert loopSensor.getVoltageEOL(VoltFunc, numberofPads=8) == window
+    with pytest.raises(ValueError):
+        loopSensor.getVoltageEOL(VoltFunc, numberofPads=0)
+
+@pytest.mark.parametrize("usePadSpacing", [True, False])
+def test_voltageWindowVsLuminosity_matches_partial_flux(hitmap, loopSensor, usePadSpacing):
+    lumi = [40, 100, 150, 260, 300]
+    _, padMinVolt, padMaxVolt, _ = loopSensor.voltageWindowVsLuminosity(VoltFunc, lumi, usePadSpacing=usePadSpacing)
+
+    sensor = SmallSensor(SHIFTS)
+    loopMinVolt = np.full(padMinVolt.shape, np.nan)
+    loopMaxVolt = np.full(padMaxVolt.shape, np.nan)
+    for k, integratedLuminosity in enumerate(lumi):
+        sensor.calculatepartialFlux(integratedLuminosity, hitmap)
+        for i, pad in enumerate(sensor.padVec):
+            minV, maxV = pad.getVoltageEOL(VoltFunc, integratedLuminosity=integratedLuminosity, usePadSpacing=usePadSpacing)
+            loopMinVolt[i, k] = np.nan if minV is None else minV
+            loopMaxVolt[i, k] = np.nan if maxV is None else maxV
+
+    np.testing.assert_array_equal(padMinVolt, loopMinVolt)
+    np.testing.assert_array_equal(padMaxVolt, loopMaxVolt)
+
+def test_fluxMap_iteration_matches_array(loopSensor):
+    fluxMap = loopSensor.padVec[5].doses[1]['fluxMap'].scaled(0.25)
+    array = fluxMap.toArray()
+
+    entries = list(fluxMap)
+    assert len(entries) == len(fluxMap) == len(array)
+    for idx in (0, 7, len(entries) - 1, -1):
+        assert fluxMap[idx] == entries[idx]
+    for field in fluxMap.fields:
+        np.testing.assert_array_equal(array[field], [entry[field] for entry in entries])
+    with pytest.raises(IndexError):
+        fluxMap[len(entries)]
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from pps_hitmaps.TiledGrid import TiledGrid
+
+@pytest.fixture
+def grids(tmp_path):
+    rng = np.random.default_rng(2)
+    grid = rng.random((37, 23))
+    grid[5:9, 3:11] = np.nan
+    filename = str(tmp_path / "grid.npy")
+    TiledGrid.save(filename, grid, 8)
+    return grid, TiledGrid(filename, grid.shape, maxTiles=3)
+
+@pytest.mark.parametrize("key", [
+    (slice(None), slice(None)),
+    (slice(3, 30), slice(7, 19)),
+    (slice(30, 3, -2), slice(None, None, 3)),
+    (12, slice(2, 20)),
+    (slice(None), -1),
+    (np.array([0, 36, 8, 8]), np.array([22, 0, 7, 8])),
+    (np.array([[1], [20]]), np.array([3, 4, 15])),
+    (np.arange(37) % 3 == 0, slice(None)),
+])
+def test_indexing_matches_numpy(grids, key):
+    grid, tiled = grids
+    np.testing.assert_array_equal(tiled[key], grid[key])
+    assert tiled.loadedTiles <= 3
+
+def test_summedArea_matches_cumsum(grids, tmp_path):
+    grid, tiled = grids
+    table = tiled.summedArea(str(tmp_path / "sat.npy"))
+
+    expected = np.zeros((grid.shape[0] + 1, grid.shape[1] + 1))
+    expected[1:, 1:] = np.cumsum(np.cumsum(np.nan_to_num(grid), axis=0), axis=1)
+    np.testing.assert_allclose(np.asarray(table), expected, rtol=1e-12)
+
+@pytest.mark.parametrize("reduce, nanReduce", [("max", np.nanmax), ("min", np.nanmin)])
+def test_blockReduce_matches_slices(grids, tmp_path, reduce, nanReduce):
+    grid, tiled = grids
+    table = np.asarray(tiled.blockReduce(str(tmp_path / "block.npy"), 2, 1, reduce))
+
+    assert table.shape == (grid.shape[0] - 3, grid.shape[1] - 1)
+    for i in range(table.shape[0]):
+        for j in range(table.shape[1]):
+            window = grid[i:i+4, j:j+2]
+            if np.isnan(window).all():
+                assert np.isnan(table[i, j])
+            else:
+                assert table[i, j] == nanReduce(window)